@@ -0,0 +1,241 @@
+"""This Python script times each stage of ios_backup_message_archiver.py on a
+backup, so changes in performance are visible.  The stages are indexing the
+backup, loading contacts, loading the chats and streaming their messages from
+the SMS database, formatting their timestamps with `time.strftime` and with
+the `TimestampFormatter` the archive uses, rendering every chat (with
+attachments) as in `main`, and copying the attachments on their own.  It
+reports wall and CPU time, messages per second and MB per second for each
+stage, and can save the results as JSON for comparison between runs.  Any
+backup can be used, or a fake one can be generated with fake_backup.py first.
+
+:Date: 2026/10/16
+"""
+
+import json
+import logging
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import fake_backup
+import ios_backup_message_archiver as archiver
+
+
+def parse_cmd_line():
+    """Parse the options and arguments from the command line.
+
+    :Returns:
+        opts, args
+    """
+    usage = "usage: %prog [options] <path to backup directory>"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option('-g', '--generate', dest='generate',
+                      help='Generate a fake backup in the backup directory first.',
+                      action="store_true", default=False)
+    parser.add_option('-c', '--chats', dest='chats', type='int',
+                      help='Number of chats to generate. [default: %default]',
+                      default=50)
+    parser.add_option('-m', '--messages', dest='messages', type='int',
+                      help='Number of messages to generate. [default: %default]',
+                      default=100000)
+    parser.add_option('-r', '--repeat', dest='repeat', type='int',
+                      help='Times to run each stage, keeping the fastest. [default: %default]',
+                      default=3)
+    parser.add_option('-t', '--copy-threads', dest='copy_threads', type='int',
+                      help='Number of threads copying attachments. [default: %default]',
+                      default=4)
+    parser.add_option('-j', '--json', dest='json_file',
+                      help='File to write the results to as JSON.')
+    opts, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('A backup directory is required.')
+    return opts, args
+
+
+class Timer(object):
+    """Times a stage in wall and CPU seconds."""
+
+    def __enter__(self):
+        self.wall = time.time()
+        self.cpu = sum(os.times()[0:2])
+        return self
+
+    def __exit__(self, *exc_info):
+        self.wall = time.time() - self.wall
+        self.cpu = sum(os.times()[0:2]) - self.cpu
+
+
+def run_stage(name, repeat, func):
+    """Run a stage `repeat` times and keep the fastest run.
+
+    :Parameters:
+        - `name`: Name of the stage (string).
+        - `repeat`: Number of runs (integer).
+        - `func`: Callable running the stage once.  It returns a dictionary of
+          the 'messages' and 'bytes' processed (either can be missing).
+
+    :Returns:
+        A dictionary of the stage's results.
+    """
+    best = None
+    for _ in range(repeat):
+        with Timer() as timer:
+            counts = func() or {}
+        if best is None or timer.wall < best['wall_seconds']:
+            best = {'stage': name, 'wall_seconds': timer.wall,
+                    'cpu_seconds': timer.cpu}
+            best.update(counts)
+    if best.get('messages'):
+        best['messages_per_second'] = best['messages'] / best['wall_seconds']
+    if best.get('bytes'):
+        best['mb_per_second'] = best['bytes'] / best['wall_seconds'] / (1024 * 1024)
+    return best
+
+def benchmark(backup_dir, repeat, copy_threads, log):
+    """Time each stage of an export of a backup.
+
+    :Parameters:
+        - `backup_dir`: Path to the backup directory (string).
+        - `repeat`: Times to run each stage (integer).
+        - `copy_threads`: Number of threads copying attachments (integer).
+        - `log`: Log object.
+
+    :Returns:
+        A list of dictionaries of each stage's results, as from `run_stage`.
+    """
+    results = []
+    state = {}
+
+    def index():
+        state['index'] = archiver.BackupIndex(backup_dir, log)
+    results.append(run_stage('index backup', repeat, index))
+    backup_index = state['index']
+    sms_db_file = backup_index.find(archiver.SMS_DB_FILE_NAME)
+    contacts_db_file = backup_index.find(archiver.CONTACTS_DB_FILE_NAME)
+
+    def contacts():
+        state['contacts'] = archiver.ContactResolver.load(contacts_db_file, None, log)
+    results.append(run_stage('load contacts', repeat, contacts))
+
+    def chat_contacts():
+        db = archiver.MessageDatabase(sms_db_file, backup_index, log)
+        try:
+            state['chat_contacts'] = db.get_chat_contacts()
+        finally:
+            db.close()
+    results.append(run_stage('load chats', repeat, chat_contacts))
+
+    def messages():
+        db = archiver.MessageDatabase(sms_db_file, backup_index, log)
+        count = 0
+        attachments = set()
+        dates = []
+        try:
+            for id, conversation in db.iter_conversations():
+                count += len(conversation)
+                for message in conversation:
+                    attachments.update(message.attachments or [])
+                    dates.append(message.date)
+                    if message.date_read:
+                        dates.append(message.date_read)
+        finally:
+            db.close()
+        state['attachments'] = attachments
+        state['dates'] = dates
+        return {'messages': count}
+    results.append(run_stage('load messages', repeat, messages))
+
+    # Counted as messages per second, though read times are formatted too.
+    dates = state['dates']
+
+    def strftime_timestamps():
+        state['strftime'] = [
+            time.strftime('%Y-%m-%d %H:%M:%S %Z', time.localtime(archiver.MAGIC_DATE_NUMBER + date))
+            for date in dates]
+        return {'messages': len(dates)}
+    results.append(run_stage('strftime timestamps', repeat, strftime_timestamps))
+
+    def cached_timestamps():
+        # A new formatter each run, so its cache is filled as in an export.
+        timestamps = archiver.TimestampFormatter()
+        state['cached'] = [timestamps.format(date) for date in dates]
+        return {'messages': len(dates)}
+    results.append(run_stage('cached timestamps', repeat, cached_timestamps))
+    if state['strftime'] != state['cached']:
+        log.error('The cached timestamps differ from strftime.')
+    del state['strftime'], state['cached']
+
+    paths = [backup_index.find(attachment_filename)
+             for attachment_filename, true_filename in state['attachments']]
+    paths = [path for path in paths if path is not None]
+    attachment_bytes = sum(os.path.getsize(path) for path in paths)
+
+    def render():
+        destination_dir = tempfile.mkdtemp(prefix='benchmark-render-')
+        try:
+            context = archiver.ArchiveContext(
+                backup_index, destination_dir, sms_db_file,
+                state['chat_contacts'], state['contacts'], log,
+                copy_threads=copy_threads)
+            context.start()
+            count = 0
+            try:
+                for id, entry, chat_stats in archiver.export_conversations(context):
+                    count += entry['message_count']
+            finally:
+                context.close()
+        finally:
+            shutil.rmtree(destination_dir)
+        return {'messages': count, 'bytes': attachment_bytes}
+    results.append(run_stage('render chats', repeat, render))
+
+    def copy():
+        destination_dir = tempfile.mkdtemp(prefix='benchmark-copy-')
+        try:
+            copier = archiver.AttachmentCopier(
+                os.path.join(destination_dir, archiver.ATTACHMENT_POOL_DIR_NAME),
+                copy_threads, log)
+            for path in paths:
+                name = os.path.basename(path)
+                copier.copy(path, name, os.path.join(destination_dir, name))
+            copier.close()
+        finally:
+            shutil.rmtree(destination_dir)
+        return {'bytes': attachment_bytes}
+    results.append(run_stage('copy attachments', repeat, copy))
+    return results
+
+def format_results(results):
+    """Format benchmark results as a text table (string)."""
+    lines = ['%-20s %10s %10s %12s %10s' % ('stage', 'wall (s)', 'cpu (s)',
+                                            'messages/s', 'MB/s')]
+    for result in results:
+        lines.append('%-20s %10.3f %10.3f %12s %10s' % (
+            result['stage'], result['wall_seconds'], result['cpu_seconds'],
+            '%.0f' % (result['messages_per_second'],) if 'messages_per_second' in result else '-',
+            '%.1f' % (result['mb_per_second'],) if 'mb_per_second' in result else '-'))
+    return '\n'.join(lines) + '\n'
+
+
+def main():
+    opts, args = parse_cmd_line()
+    log = logging.getLogger('iOS_messages_exporter')
+    log.addHandler(logging.StreamHandler(sys.stderr))
+    backup_dir = args[0]
+    if opts.generate:
+        summary = fake_backup.generate(backup_dir, opts.chats, opts.messages)
+        sys.stdout.write('Generated %(chats)d chats, %(messages)d messages and '
+                         '%(attachments)d attachments (%(attachment_bytes)d bytes).\n' % summary)
+    results = benchmark(backup_dir, opts.repeat, opts.copy_threads, log)
+    sys.stdout.write(format_results(results))
+    if opts.json_file:
+        with open(opts.json_file, 'w') as fh:
+            json.dump({'backup_dir': backup_dir, 'stages': results}, fh,
+                      indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,344 @@
+"""This Python script generates a fake iOS backup for testing and benchmarking
+ios_backup_message_archiver.py without a real phone backup.  The backup has an
+SMS database with the tables the archiver reads (message, chat, handle,
+attachment and their join tables, with the indexes iOS creates), an address
+book database, and random attachment files named by their hashed domain path.
+Files can be laid out flat, as before iOS 10, or in two-character
+subdirectories with a Manifest.db, as from iOS 10.  The content is random but
+repeatable for a given seed.
+
+:Date: 2026/10/16
+"""
+
+import bisect
+import hashlib
+import logging
+import optparse
+import os
+import random
+import sqlite3
+import sys
+
+import ios_backup_message_archiver as archiver
+
+
+SMS_SCHEMA = """
+CREATE TABLE handle (ROWID INTEGER PRIMARY KEY AUTOINCREMENT UNIQUE,
+    id TEXT NOT NULL, country TEXT, service TEXT NOT NULL,
+    uncanonicalized_id TEXT, UNIQUE (id, service));
+CREATE TABLE chat (ROWID INTEGER PRIMARY KEY AUTOINCREMENT, guid TEXT UNIQUE NOT NULL,
+    style INTEGER, chat_identifier TEXT, service_name TEXT, display_name TEXT);
+CREATE TABLE message (ROWID INTEGER PRIMARY KEY AUTOINCREMENT, guid TEXT UNIQUE NOT NULL,
+    text TEXT, handle_id INTEGER DEFAULT 0, service TEXT, date INTEGER,
+    date_read INTEGER, date_delivered INTEGER, is_from_me INTEGER DEFAULT 0,
+    is_read INTEGER DEFAULT 0, cache_has_attachments INTEGER DEFAULT 0);
+CREATE TABLE attachment (ROWID INTEGER PRIMARY KEY AUTOINCREMENT, guid TEXT UNIQUE NOT NULL,
+    filename TEXT, mime_type TEXT, transfer_name TEXT, total_bytes INTEGER DEFAULT 0);
+CREATE TABLE chat_handle_join (chat_id INTEGER REFERENCES chat (ROWID) ON DELETE CASCADE,
+    handle_id INTEGER REFERENCES handle (ROWID) ON DELETE CASCADE,
+    UNIQUE(chat_id, handle_id));
+CREATE TABLE chat_message_join (chat_id INTEGER REFERENCES chat (ROWID) ON DELETE CASCADE,
+    message_id INTEGER REFERENCES message (ROWID) ON DELETE CASCADE,
+    message_date INTEGER DEFAULT 0, PRIMARY KEY (chat_id, message_id));
+CREATE TABLE message_attachment_join (message_id INTEGER REFERENCES message (ROWID) ON DELETE CASCADE,
+    attachment_id INTEGER REFERENCES attachment (ROWID) ON DELETE CASCADE,
+    UNIQUE(message_id, attachment_id));
+CREATE INDEX chat_message_join_idx_message_id_only ON chat_message_join(message_id);
+CREATE INDEX message_attachment_join_idx_message_id ON message_attachment_join(message_id);
+CREATE INDEX message_idx_handle ON message(handle_id, date);
+"""
+
+CONTACTS_SCHEMA = """
+CREATE TABLE ABPerson (ROWID INTEGER PRIMARY KEY AUTOINCREMENT, First TEXT, Last TEXT,
+    Organization TEXT);
+CREATE TABLE ABMultiValue (UID INTEGER PRIMARY KEY, record_id INTEGER, property INTEGER,
+    identifier INTEGER, label INTEGER, value TEXT);
+CREATE INDEX ABMultiValueRecordIDIndex ON ABMultiValue(record_id);
+"""
+
+MANIFEST_SCHEMA = """
+CREATE TABLE Files (fileID TEXT PRIMARY KEY, domain TEXT, relativePath TEXT,
+    flags INTEGER, file BLOB);
+CREATE INDEX FilesDomainIdx ON Files(domain);
+"""
+
+FIRST_NAMES = ['Alex', 'Sam', 'Jordan', 'Taylor', 'Morgan', 'Casey', 'Riley',
+               'Jamie', 'Avery', 'Quinn', u'Zo\xeb', u'Ren\xe9']
+LAST_NAMES = ['Smith', 'Jones', 'Garcia', 'Chen', 'Patel', 'Nguyen', 'Kim',
+              'Silva', u'M\xfcller', "O'Brien"]
+ORGANIZATIONS = ['Pharmacy', 'Dentist', 'Pizza Place', 'Bank']
+WORDS = ('the be to of and a in that have I it for not on with he as you do at '
+         'this but his by from they we say her she or an will my one all would '
+         'there their what so up out if about who get which go me when make '
+         'can like time no just him know take people into year your good some '
+         'lunch dinner tomorrow tonight ok haha lol sure thanks see soon').split()
+ATTACHMENT_TYPES = [('jpeg', 'image/jpeg', 6), ('png', 'image/png', 2),
+                    ('gif', 'image/gif', 1), ('mov', 'video/quicktime', 1),
+                    ('pdf', 'application/pdf', 1), ('vcf', 'text/vcard', 1)]
+NANOSECOND_DATES_FROM = 526000000 # Dates in nanoseconds after this (iOS 11).
+DATE_START = 460000000 # Seconds after the magic date, in 2015.
+HISTORY_SECONDS = 4 * 365 * 24 * 60 * 60 # Messages are spread over this long.
+
+
+def parse_cmd_line():
+    """Parse the options and arguments from the command line.
+
+    :Returns:
+        opts, args
+    """
+    usage = "usage: %prog [options] <path to new backup directory>"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option('-c', '--chats', dest='chats', type='int',
+                      help='Number of chats. [default: %default]',
+                      default=20)
+    parser.add_option('-m', '--messages', dest='messages', type='int',
+                      help='Total number of messages. [default: %default]',
+                      default=10000)
+    parser.add_option('-a', '--attachment-rate', dest='attachment_rate', type='float',
+                      help='Fraction of messages with an attachment. [default: %default]',
+                      default=0.05)
+    parser.add_option('-s', '--attachment-size', dest='attachment_size', type='int',
+                      help='Average attachment size in KiB. [default: %default]',
+                      default=64)
+    parser.add_option('-g', '--group-rate', dest='group_rate', type='float',
+                      help='Fraction of chats that are group chats. [default: %default]',
+                      default=0.2)
+    parser.add_option('-l', '--layout', dest='layout', type='choice',
+                      choices=['flat', 'two-level'],
+                      help='"flat" for files in the backup directory (before iOS 10) or "two-level" for subdirectories and a Manifest.db. [default: %default]',
+                      default='two-level')
+    parser.add_option('-r', '--seed', dest='seed', type='int',
+                      help='Random seed. [default: %default]',
+                      default=1)
+    opts, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('A backup directory is required.')
+    return opts, args
+
+
+class FakeBackup(object):
+    """Writes the files of a fake iOS backup."""
+
+    def __init__(self, backup_dir, layout, rand):
+        """
+        :Parameters:
+            - `backup_dir`: Directory to create the backup in (string).
+            - `layout`: 'flat' or 'two-level'.
+            - `rand`: A `random.Random` for the content.
+        """
+        self.backup_dir = backup_dir
+        self.layout = layout
+        self.rand = rand
+        # Tuples of (fileID, domain, relativePath) for the Manifest.db.
+        self.files = []
+        if not os.access(backup_dir, os.F_OK):
+            os.makedirs(backup_dir)
+
+    def get_path(self, file_id):
+        """Get the path of a backup file, creating its directory if needed."""
+        if self.layout == 'flat':
+            return os.path.join(self.backup_dir, file_id)
+        sub_dir = os.path.join(self.backup_dir, file_id[0:2])
+        if not os.access(sub_dir, os.F_OK):
+            os.mkdir(sub_dir)
+        return os.path.join(sub_dir, file_id)
+
+    def new_database(self, file_id, domain, relative_path, schema):
+        """Create an empty SQLite DB in the backup and return a connection."""
+        path = self.get_path(file_id)
+        if os.access(path, os.F_OK):
+            os.remove(path)
+        self.files.append((file_id, domain, relative_path))
+        conn = sqlite3.connect(path)
+        conn.executescript(schema)
+        return conn
+
+    def add_file(self, domain_path, size):
+        """Write a random file for a domain path, returning its size."""
+        domain, relative_path = domain_path.split('-', 1)
+        file_id = hashlib.sha1(domain_path.encode('utf8')).hexdigest()
+        with open(self.get_path(file_id), 'wb') as fh:
+            fh.write(os.urandom(size))
+        self.files.append((file_id, domain, relative_path))
+        return size
+
+    def write_manifest(self):
+        """Write the Manifest.db listing every file, for the two-level layout."""
+        if self.layout == 'flat':
+            return
+        path = os.path.join(self.backup_dir, archiver.MANIFEST_DB_FILE_NAME)
+        if os.access(path, os.F_OK):
+            os.remove(path)
+        conn = sqlite3.connect(path)
+        conn.executescript(MANIFEST_SCHEMA)
+        conn.executemany('INSERT INTO Files VALUES (?, ?, ?, 1, NULL);', self.files)
+        conn.commit()
+        conn.close()
+
+
+def make_phone_number(rand):
+    """Generate a random North American phone number as in the handle table."""
+    return '+1%03d555%04d' % (rand.randint(201, 989), rand.randint(0, 9999))
+
+def make_text(rand):
+    """Generate random message text, sometimes spanning lines or missing."""
+    if rand.random() < 0.03:
+        return None
+    words = [rand.choice(WORDS) for _ in range(int(rand.expovariate(1 / 9.0)) + 1)]
+    if rand.random() < 0.05:
+        words.insert(rand.randint(0, len(words)), '\n')
+    return ' '.join(words)
+
+def write_contacts(conn, handles, rand):
+    """Write address book entries for most of the handles.
+
+    Phone numbers are written in a variety of formats, as people enter them.
+    """
+    formats = ['(%s) %s-%s', '%s-%s-%s', '%s.%s.%s', '+1 %s %s %s', '1%s%s%s']
+    for handle in handles:
+        if rand.random() < 0.2:
+            continue
+        if rand.random() < 0.1:
+            person = (None, None, rand.choice(ORGANIZATIONS))
+        else:
+            person = (rand.choice(FIRST_NAMES), rand.choice(LAST_NAMES), None)
+        c = conn.execute('INSERT INTO ABPerson (First, Last, Organization) VALUES (?, ?, ?);',
+                         person)
+        if '@' in handle:
+            conn.execute('INSERT INTO ABMultiValue (record_id, property, value) VALUES (?, 4, ?);',
+                         (c.lastrowid, handle))
+        else:
+            digits = handle[2:]
+            number = rand.choice(formats) % (digits[0:3], digits[3:6], digits[6:])
+            conn.execute('INSERT INTO ABMultiValue (record_id, property, value) VALUES (?, 3, ?);',
+                         (c.lastrowid, number))
+
+def generate(backup_dir, chats=20, messages=10000, attachment_rate=0.05,
+             attachment_size=64, group_rate=0.2, layout='two-level', seed=1):
+    """Generate a fake backup.
+
+    :Parameters:
+        - `backup_dir`: Directory to create the backup in (string).
+        - `chats`: Number of chats.
+        - `messages`: Total number of messages.
+        - `attachment_rate`: Fraction of messages with an attachment.
+        - `attachment_size`: Average attachment size in KiB.
+        - `group_rate`: Fraction of chats that are group chats.
+        - `layout`: 'flat' or 'two-level'.
+        - `seed`: Random seed.
+
+    :Returns:
+        A dictionary of what was generated: 'chats', 'messages',
+        'attachments' and 'attachment_bytes'.
+    """
+    rand = random.Random(seed)
+    backup = FakeBackup(backup_dir, layout, rand)
+    sms = backup.new_database(archiver.SMS_DB_FILE_NAME, 'HomeDomain',
+                              'Library/SMS/sms.db', SMS_SCHEMA)
+    contacts = backup.new_database(archiver.CONTACTS_DB_FILE_NAME, 'HomeDomain',
+                                   'Library/AddressBook/AddressBook.sqlitedb',
+                                   CONTACTS_SCHEMA)
+
+    # Handles, with the same number often having both an SMS and iMessage one.
+    handle_ids = {}
+    chat_members = []
+    for chat_number in range(chats):
+        members = []
+        people = rand.randint(2, 6) if rand.random() < group_rate else 1
+        for _ in range(people):
+            if rand.random() < 0.15:
+                contact = 'person%d@example.com' % (rand.randint(0, 10 ** 6),)
+            else:
+                contact = make_phone_number(rand)
+            for service in ['iMessage', 'SMS'] if rand.random() < 0.5 else ['iMessage']:
+                if (contact, service) not in handle_ids:
+                    c = sms.execute('INSERT INTO handle (id, country, service, uncanonicalized_id) VALUES (?, ?, ?, ?);',
+                                    (contact, 'us', service, contact))
+                    handle_ids[(contact, service)] = c.lastrowid
+                members.append(handle_ids[(contact, service)])
+        if people > 1:
+            chat_identifier = 'chat%d' % (rand.randint(10 ** 17, 10 ** 18),)
+        else:
+            chat_identifier = contact
+        c = sms.execute('INSERT INTO chat (guid, style, chat_identifier, service_name) VALUES (?, ?, ?, ?);',
+                        ('iMessage;-;%s;%d' % (chat_identifier, chat_number),
+                         43 if len(members) > 2 else 45, chat_identifier, 'iMessage'))
+        chat_members.append((c.lastrowid, members))
+        sms.executemany('INSERT INTO chat_handle_join VALUES (?, ?);',
+                        [(c.lastrowid, member) for member in members])
+    write_contacts(contacts, sorted(set(handle[0] for handle in handle_ids)), rand)
+
+    # Messages, with chat sizes skewed so a few chats hold most of them.
+    weights = [rand.paretovariate(1.2) for _ in chat_members]
+    total_weight = sum(weights)
+    cumulative = []
+    running = 0
+    for weight in weights:
+        running += weight / total_weight
+        cumulative.append(running)
+    date = DATE_START
+    mean_gap = float(HISTORY_SECONDS) / max(messages, 1)
+    attachment_count = 0
+    attachment_bytes = 0
+    log = logging.getLogger('fake_backup')
+    for message_number in range(messages):
+        chat_id, members = chat_members[min(bisect.bisect(cumulative, rand.random()),
+                                            len(chat_members) - 1)]
+        date += int(rand.expovariate(1 / mean_gap)) + 1
+        is_from_me = rand.random() < 0.45
+        handle_id = 0 if is_from_me else rand.choice(members)
+        service = 'SMS' if rand.random() < 0.2 else 'iMessage'
+        date_read = 0
+        if service == 'iMessage' and not is_from_me and rand.random() < 0.8:
+            date_read = date + rand.randint(1, 3600)
+        if date > NANOSECOND_DATES_FROM:
+            stored_date = date * archiver.NANOSECONDS
+            stored_date_read = date_read * archiver.NANOSECONDS
+        else:
+            stored_date = date
+            stored_date_read = date_read
+        c = sms.execute("""INSERT INTO message (guid, text, handle_id, service, date, date_read,
+            is_from_me, is_read) VALUES (?, ?, ?, ?, ?, ?, ?, ?);""",
+                        ('guid-%d' % (message_number,), make_text(rand), handle_id,
+                         service, stored_date, stored_date_read, int(is_from_me),
+                         int(bool(date_read))))
+        message_id = c.lastrowid
+        sms.execute('INSERT INTO chat_message_join VALUES (?, ?, ?);',
+                    (chat_id, message_id, stored_date))
+        if rand.random() < attachment_rate:
+            extension = rand.choice([t for t in ATTACHMENT_TYPES for _ in range(t[2])])
+            name = 'IMG_%04d.%s' % (attachment_count, extension[0].upper())
+            filename = '~/Library/SMS/Attachments/%02x/%02d/%s/%s' % (
+                rand.randint(0, 255), rand.randint(0, 15),
+                'ABCD-%d' % (attachment_count,), name)
+            size = max(1, int(rand.expovariate(1.0 / (attachment_size * 1024))))
+            # A few attachments are missing from the backup, as in real ones.
+            if rand.random() < 0.98:
+                attachment_bytes += backup.add_file(
+                    archiver.get_attachment_domain_path(filename, log), size)
+            c = sms.execute("""INSERT INTO attachment (guid, filename, mime_type, transfer_name,
+                total_bytes) VALUES (?, ?, ?, ?, ?);""",
+                            ('att-%d' % (attachment_count,), filename, extension[1], name, size))
+            sms.execute('INSERT INTO message_attachment_join VALUES (?, ?);',
+                        (message_id, c.lastrowid))
+            attachment_count += 1
+
+    for conn in (sms, contacts):
+        conn.commit()
+        conn.close()
+    backup.write_manifest()
+    return {'chats': len(chat_members), 'messages': messages,
+            'attachments': attachment_count, 'attachment_bytes': attachment_bytes}
+
+
+def main():
+    opts, args = parse_cmd_line()
+    summary = generate(args[0], opts.chats, opts.messages, opts.attachment_rate,
+                       opts.attachment_size, opts.group_rate, opts.layout,
+                       opts.seed)
+    sys.stdout.write('Generated %(chats)d chats, %(messages)d messages and '
+                     '%(attachments)d attachments (%(attachment_bytes)d bytes).\n' % summary)
+
+
+if __name__ == "__main__":
+    main()
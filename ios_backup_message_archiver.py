@@ -20,26 +20,82 @@ HTML and file names.
 :Last Update: 2018/04/14
 """
 
+import bisect
+import collections
+import errno
+import gzip
 import hashlib
+import itertools
+import json
 import logging
+import multiprocessing
+import multiprocessing.pool
 import optparse
 import os
 import shutil
 import sqlite3
 import sys
+import tarfile
+import tempfile
+import threading
 import time
+import urllib
+import zipfile
+
+try:
+    from PIL import Image
+except ImportError:
+    # Only needed for --thumbnails.
+    Image = None
 
 
 MAGIC_DATE_NUMBER = 978307200
 NANOSECONDS = 1000000000
+SECONDS_PER_DAY = 24 * 60 * 60
 SMS_DB_FILE_NAME = '3d0d7e5fb2ce288813306e4d4636395e047a3d28'
 CONTACTS_DB_FILE_NAME = '31bb7ba8914766d4ba40d6dfb6113c8b614be442'
+MANIFEST_DB_FILE_NAME = 'Manifest.db'
+MANIFEST_FILE_NAME = '.archive_manifest.json'
+# The last message of each chat written to --ndjson by an incremental export.
+NDJSON_MARKS_FILE_NAME = '.ndjson_exported.json'
+# The journal's header, and the prefix of each process's journal file.
+JOURNAL_FILE_NAME = '.export_journal'
+JOURNAL_VERSION = 1
+ATTACHMENT_POOL_DIR_NAME = '.attachments'
+# Content digests of the backup files in a shared attachment pool, and the
+# prefix of each process's file of digests it worked out.
+CONTENT_DIGESTS_FILE_NAME = '.attachment_digests'
+CONTACTS_CACHE_FILE_NAME = '.contacts_cache'
+CONTACTS_CACHE_VERSION = 4
+SEARCH_DB_FILE_NAME = 'search.db'
+THUMBNAIL_DIR_NAME = '.thumbnails'
+# Attachment extensions thumbnailed, to the extension of their thumbnails.
+# PNG keeps transparency.
+THUMBNAIL_EXTENSIONS = {'jpeg': 'jpg', 'jpg': 'jpg', 'png': 'png', 'gif': 'png'}
+THUMBNAIL_JPEG_QUALITY = 80
+# Attachments stored without compression in a zip container, as compressing
+# them again gains nothing.
+STORED_EXTENSIONS = frozenset(['jpeg', 'jpg', 'png', 'gif', 'heic', 'mov', 'mp4', 'm4v',
+                               'm4a', 'mp3', 'aac', 'amr', 'caf', 'pdf', 'zip', 'gz',
+                               'pluginpayloadattachment'])
+# Container file extensions to tarfile stream modes.
+TAR_MODES = [('.tar', 'w|'), ('.tar.gz', 'w|gz'), ('.tgz', 'w|gz'), ('.tar.bz2', 'w|bz2')]
+NDJSON_GZIP_LEVEL = 6
+# Bytes read at a time hashing attachments for a shared pool.
+CONTENT_HASH_BLOCK_SIZE = 1024 * 1024
+# Seconds between checks on a pooled copy or thumbnail being made by another
+# process.
+COPY_WAIT_SECONDS = 0.05
+# Lines of NDJSON written at a time.
+NDJSON_BATCH_SIZE = 1000
+# Seconds a worker waits for another to finish writing to the search index.
+SEARCH_DB_TIMEOUT = 300
+FULL_NUMBER_DIGITS = 10 # Trailing digits matched: area code and number.
+LOCAL_NUMBER_DIGITS = 7 # Digits of a number without an area code.
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024 # Bytes.
+SQLITE_CACHE_SIZE = -64 * 1024 # Negative for KiB rather than pages.
 
 
-# A chat could have 1 or more people (group messaging) and a single person could be in more than 1 chat.
-CHAT_HANDLE_JOIN_FIELDS = ['chat_id',   # An integer used to identify the chat.
-                           'handle_id'] # An integer used to identify a contact / phone number.
-
 CHAT_MESSAGE_JOIN_FIELDS = ['chat_id',    # An integer used to identify the chat.
                             'message_id'] # Integer identifier for a single message sent/received.
 
@@ -55,142 +111,63 @@ MESSAGE_FIELDS = ['text',       # Text from the message.
                   'is_read']    # 1 = the message was read, 0 = the message was not read (or we don't know).
                   # 'ROWID'     # Used elsewhere as message_id (integer).
 
-HANDLE_FIELDS = ['ROWID', # Used elsewhere as handle_id (integer).
-                 'id']    # Phone number or email.
-
-MESSAGE_ATTACHMENT_JOIN_FIELDS = ['message_id',    # Integer identifier for a single message sent/received.
-                                  'attachment_id'] # Integer identifier for a single attachment file.
-ATTACHMENT_FIELDS = ['ROWID',    # Used elsewhere as attachment_id (integer).
-                     'filename'] # Path on iOS.
 
+def connect_read_only(filename):
+    """Open a SQLite DB from the backup for reading.
 
-def get_handle_to_contact(filename, log):
-    """Get information from the SQLite DB about contacts.
+    The DB is opened as an immutable, read-only URI where SQLite allows it,
+    so no locking or change detection is done, and the page cache and memory
+    mapping are enlarged for the bulk reads done here.
 
     :Parameters:
         - `filename`: Path to the SQLite DB file (as a string).
-        - `log`: Log object.
 
     :Returns:
-        A dictionary mapping contact handle ID (integer) to contact information
-        (phone number ('12223334444') or email as a string).
+        A sqlite3 connection.
 
     :Exceptions:
         Standard exceptions from sqlite3 library.
     """
-    conn = sqlite3.connect(filename)
-    c = conn.cursor()
-    c.execute("SELECT %s FROM `handle`;" % (', '.join(HANDLE_FIELDS),))
-    result = c.fetchall()
-    conn.close()
-
-    # Create a mapping from handle to contact information.
-    handle_contact_map = {}
-    for handle_id, contact in result:
-        if contact.startswith('+'):
-            contact = contact.lstrip('+')
-        handle_contact_map[handle_id] = contact
-    # Handle a new oddity seen in iOS 10 where a handle ID is 0 in a message
-    # but is not in handle table.
-    if not handle_contact_map.get(0):
-        handle_contact_map[0] = 'me-or-null'
-    return handle_contact_map
-
-def get_contacts_in_chat(filename, log):
-    """Get information from the SQLite DB about contacts in chats.
+    uri = 'file:%s?mode=ro&immutable=1' % (urllib.pathname2url(os.path.abspath(filename)),)
+    try:
+        conn = sqlite3.connect(uri, uri=True)
+    except TypeError:
+        # Older sqlite3 modules take a URI as the filename when SQLite itself
+        # was built to allow it, otherwise it would name a new, empty DB.
+        if sqlite_uri_filenames():
+            conn = sqlite3.connect(uri)
+        else:
+            conn = sqlite3.connect(filename)
+    conn.execute('PRAGMA mmap_size=%d;' % (SQLITE_MMAP_SIZE,))
+    conn.execute('PRAGMA cache_size=%d;' % (SQLITE_CACHE_SIZE,))
+    return conn
 
-    :Parameters:
-        - `filename`: Path to the SQLite DB file (as a string).
-        - `log`: Log object.
+def sqlite_uri_filenames():
+    """Check whether the SQLite library accepts URI filenames by default.
 
     :Returns:
-        A dictionary mapping a chat identifier (string) to a list of contacts
-        (handle ID (integer)).
-
-    :Exceptions:
-        Standard exceptions from sqlite3 library.
+        True if SQLite was built with USE_URI.
     """
-    # Users in a chat.
-    chat_and_chat_handle_join = CHAT_HANDLE_JOIN_FIELDS + CHAT_FIELDS
-    sql = """SELECT %s
-    FROM `chat_handle_join`
-    INNER JOIN `chat`
-    ON chat_handle_join.chat_id=chat.ROWID
-    ORDER BY chat_identifier ASC;"""
-    conn = sqlite3.connect(filename)
-    c = conn.cursor()
-    c.execute(sql % (', '.join(chat_and_chat_handle_join),))
-    result = c.fetchall()
-    conn.close()
+    conn = sqlite3.connect(':memory:')
+    try:
+        options = [row[0] for row in conn.execute('PRAGMA compile_options;')]
+    finally:
+        conn.close()
+    return 'USE_URI' in options
 
-    contacts_in_chat = {}
-    for chat_id, handle_id, chat_identifier in result:
-        if chat_identifier not in contacts_in_chat:
-            contacts_in_chat[chat_identifier] = []
-        contacts_in_chat[chat_identifier].append(handle_id)
-    return contacts_in_chat
+def get_attachment_domain_path(name, log):
+    """Generate the domain path of the attachment in the iOS backup.
 
-def get_chat_coversations(filename, log):
-    """Get information from the SQLite DB about messages in chats.
-
-    :Parameters:
-        - `filename`: Path to the SQLite DB file (as a string).
-        - `log`: Log object.
-
-    :Returns:
-        A dictionary mapping a chat identifier (string) to a list of
-        dictionaries that represent messages.  These contain a mapping of column
-        name to column data from 'message' and 'chat_message_join' tables.  It
-        looks something like:
-        {<chat_identifier>: [{'ROWID': <ROWID>, 'text': <text>, ...}, {...}, ...], ...}
-
-    :Exceptions:
-        Standard exceptions from sqlite3 library.
-    """
-    # [ROWID, text, handle_id, service, date, date_read, is_from_me, is_read,
-    #  chat_id, message_id]
-    message_and_chat_message_join = MESSAGE_FIELDS + CHAT_MESSAGE_JOIN_FIELDS + CHAT_FIELDS
-    sql = """SELECT %s
-    FROM `message`
-    INNER JOIN `chat_message_join`
-    ON message.ROWID=chat_message_join.message_id
-    INNER JOIN `chat`
-    ON chat_message_join.chat_id=chat.ROWID
-    ORDER BY message_id ASC;"""
-    conn = sqlite3.connect(filename)
-    c = conn.cursor()
-    c.execute(sql % (', '.join(message_and_chat_message_join),))
-    result = c.fetchall()
-    conn.close()
-
-    conversations = {}
-    for message_row in result:
-        message_info = dict(zip(message_and_chat_message_join, message_row))
-        # Dates appear to be in nanoseconds, now. Probably changed around iOS
-        # 11. This code wants seconds, as does Python.
-        if message_info['date'] > NANOSECONDS:
-            message_info['date'] = int(message_info['date'] / NANOSECONDS)
-        if message_info['date_read'] > NANOSECONDS:
-            message_info['date_read'] = int(message_info['date_read'] / NANOSECONDS)
-        if not message_info['chat_identifier'] in conversations:
-            conversations[message_info['chat_identifier']] = []
-        conversations[message_info['chat_identifier']].append(message_info)
-    return conversations
-
-def convert_attachment_name(name, log):
-    """Generate the hashed filename of the attachment in the iOS backup.
-
-    In the backup directory, the attachments are named based on tweaking the
-    iOS file path and taking a hash of it.  Simply, a leading chunk is
-    replaced and the SHA1 hash is taken of the string.
+    A leading chunk of the iOS file path is replaced by the backup domain.
+    This is what is hashed to name the file in the backup directory.
 
     :Parameters:
         - `name`: Full path to the attachment on the iOS filesystem (string).
         - `log`: Log object.
 
     :Returns:
-        A string of the hashed filename that can be found in the iOS backup
-        directory.
+        A string like 'MediaDomain-Library/SMS/Attachments/...', or an empty
+        string for a path that can't be mapped.
     """
     # Replace the '/var/mobile/' or '~/' with 'MediaDomain-'.
     # http://apple.stackexchange.com/questions/77432/location-of-message-attachments-in-ios-6-backup
@@ -201,48 +178,398 @@ def convert_attachment_name(name, log):
     else:
         log.warn('Bad data in the attachments table. Bad filename: %s', name)
         new_name = ''
-    # Take the SHA1 hash of the above filename.
-    hashed_name = hashlib.sha1(new_name).hexdigest()
-    return hashed_name
+    return new_name
 
-def get_message_attachments(filename, log):
-    """Get information from the SQLite DB about message attachments.
 
-    :Parameters:
-        - `filename`: Path to the SQLite DB file (as a string).
-        - `log`: Log object.
+class BackupIndex(object):
+    """Index of the files in an iOS backup directory.
 
-    :Returns:
-        A dictionary mapping a message ID (integer) to a list of tuples that
-        represent all the attachments to that message.  The tuples contain the
-        filename of the attachment in the iOS backup directory (string) and
-        the original filename on the iOS filesystem (string).
+    Built once per run so looking up a file in the backup is a dictionary hit
+    rather than a stat of the flat and two-level layouts.  The directory is
+    listed once to find the files present.  When the backup has a Manifest.db
+    (iOS 10 and later), its Files table also maps domain paths to backup
+    names, so those don't need to be hashed.
+    """
 
-    :Exceptions:
-        Standard exceptions from sqlite3 library.
+    def __init__(self, backup_dir, log):
+        """
+        :Parameters:
+            - `backup_dir`: Path to the backup directory (string).
+            - `log`: Log object.
+
+        :Exceptions:
+            OSError if the backup directory can't be listed.  Standard
+            exceptions from sqlite3 library for a bad Manifest.db.
+        """
+        self.backup_dir = backup_dir
+        self.log = log
+        # Backup file name (string) to path on disk (string).
+        self._paths = {}
+        # Domain path (string) to backup file name (string).
+        self._file_ids = {}
+        for name in os.listdir(backup_dir):
+            path = os.path.join(backup_dir, name)
+            if len(name) == 2 and os.path.isdir(path):
+                for sub_name in os.listdir(path):
+                    self._paths[sub_name] = os.path.join(path, sub_name)
+            else:
+                self._paths.setdefault(name, path)
+        if MANIFEST_DB_FILE_NAME in self._paths:
+            self._load_manifest_db(self._paths[MANIFEST_DB_FILE_NAME])
+        log.debug('Indexed %d backup files and %d domain paths.',
+                  len(self._paths), len(self._file_ids))
+
+    def _load_manifest_db(self, filename):
+        sql = """SELECT fileID, domain, relativePath
+        FROM `Files`
+        WHERE domain='MediaDomain';"""
+        conn = connect_read_only(filename)
+        try:
+            c = conn.cursor()
+            c.execute(sql)
+            for file_id, domain, relative_path in c:
+                self._file_ids[u'%s-%s' % (domain, relative_path)] = str(file_id)
+        finally:
+            conn.close()
+
+    def find(self, file_id):
+        """Get the path of a file in the backup.
+
+        :Parameters:
+            - `file_id`: The hashed name of the file in the backup (string).
+
+        :Returns:
+            The path to the file (string), or None if it is not in the
+            backup.
+        """
+        return self._paths.get(file_id)
+
+    def get_file_id(self, domain_path):
+        """Get the hashed name of a file in the backup from its domain path.
+
+        :Parameters:
+            - `domain_path`: As from `get_attachment_domain_path` (string).
+
+        :Returns:
+            The hashed name (string).
+        """
+        file_id = self._file_ids.get(domain_path)
+        if file_id is None:
+            if isinstance(domain_path, unicode):
+                domain_path = domain_path.encode('utf8')
+            file_id = hashlib.sha1(domain_path).hexdigest()
+        return file_id
+
+
+# Fields of each `Message` from `MessageDatabase`.  'handle' is the phone number
+# or email of the sender (or None) and 'attachments' a list of tuples of the
+# attachment's filename in the backup directory and original filename (or
+# None).
+MESSAGE_ROW_FIELDS = (MESSAGE_FIELDS + CHAT_MESSAGE_JOIN_FIELDS + CHAT_FIELDS +
+                      ['handle', 'attachments'])
+# A message.  A tuple rather than a dictionary as there can be millions.
+Message = collections.namedtuple('Message', MESSAGE_ROW_FIELDS)
+ATTACHMENT_SEPARATOR = '\x1f'
+# Dates appear to be in nanoseconds, now. Probably changed around iOS 11.
+# This code wants seconds, as does Python.  Converted in SQL, as backups can
+# have both.
+# A NULL date is taken as 0, like an unknown read time.
+SECONDS_DATE_SQL = 'IFNULL(CASE WHEN message.%%(field)s > %d THEN message.%%(field)s / %d ELSE message.%%(field)s END, 0)' % (
+    NANOSECONDS, NANOSECONDS)
+MESSAGE_SQL = """SELECT %s, %s, chat.chat_identifier,
+    LTRIM(handle.id, '+') AS handle,
+    (SELECT group_concat(attachment.filename, ?)
+     FROM `message_attachment_join`
+     INNER JOIN `attachment`
+     ON message_attachment_join.attachment_id=attachment.ROWID
+     WHERE message_attachment_join.message_id=message.ROWID) AS attachments
+    FROM `message`
+    INNER JOIN `chat_message_join`
+    ON message.ROWID=chat_message_join.message_id
+    INNER JOIN `chat`
+    ON chat_message_join.chat_id=chat.ROWID
+    LEFT JOIN `handle`
+    ON message.handle_id=handle.ROWID
+    %%s
+    ORDER BY chat_identifier ASC, message_id ASC;""" % (
+    ', '.join([SECONDS_DATE_SQL % {'field': field} if field in ('date', 'date_read')
+               else 'message.' + field for field in MESSAGE_FIELDS]),
+    ', '.join(['chat_message_join.' + field for field in CHAT_MESSAGE_JOIN_FIELDS]))
+# Used with a `last_exported` temp table to only select messages newer than
+# the last export of each chat.
+LAST_EXPORTED_PREDICATE = """message.ROWID > IFNULL(
+    (SELECT message_id FROM temp.last_exported
+     WHERE last_exported.chat_identifier=chat.chat_identifier), 0)"""
+# Chats with any of the given handles in them, for `MessageFilter`.
+CONTACT_PREDICATE = """chat.ROWID IN
+    (SELECT chat_handle_join.chat_id
+     FROM `chat_handle_join`
+     INNER JOIN `handle`
+     ON chat_handle_join.handle_id=handle.ROWID
+     WHERE %s)"""
+# Matches a date in either encoding exactly as `SECONDS_DATE_SQL` converts it,
+# so only the seconds or the nanoseconds range applies to each message.
+DATE_PREDICATE = """((message.date <= %d AND message.date %%(op)s ?)
+     OR (message.date > %d AND message.date %%(op)s ?))""" % (NANOSECONDS, NANOSECONDS)
+
+
+class MessageFilter(object):
+    """Selects the messages to export, for the --chat, --contact, --since and
+    --until options.
+
+    The selection is done in SQL, so messages outside it, and their
+    attachments, are never read.
     """
-    # [message_id, attachment_id, ROWID, filename]
-    message_attachment_fields = MESSAGE_ATTACHMENT_JOIN_FIELDS + ATTACHMENT_FIELDS
-    sql = """SELECT %s
-    FROM `message_attachment_join`
-    INNER JOIN `attachment`
-    ON message_attachment_join.attachment_id=attachment.ROWID;"""
-    conn = sqlite3.connect(filename)
-    c = conn.cursor()
-    c.execute(sql % (', '.join(message_attachment_fields),))
-    result = c.fetchall()
-    conn.close()
-
-    attachments = {}
-    for attachment_row in result:
-        attachment_info = dict(zip(message_attachment_fields, attachment_row))
-        if not attachment_info['message_id'] in attachments:
-            attachments[attachment_info['message_id']] = []
-        attachment_filename = convert_attachment_name(attachment_info['filename'], log)
-        orig_filename = os.path.basename(attachment_info['filename'])
-        attachments[attachment_info['message_id']].append((attachment_filename,
-                                                           orig_filename))
-    return attachments
+
+    def __init__(self, chats=None, contacts=None, since=None, until=None):
+        """
+        :Parameters:
+            - `chats`: Optional list of chat identifiers (strings) to export.
+            - `contacts`: Optional list of phone numbers or emails (strings).
+              Chats with any of them in are exported.  Phone numbers match on
+              their digits, ignoring a missing country code.
+            - `since`: Optional first date to export, in seconds after the
+              magic date.
+            - `until`: Optional date to export up to (not including), in
+              seconds after the magic date.
+        """
+        self.chats = chats or []
+        self.contacts = contacts or []
+        self.since = since
+        self.until = until
+
+    def get_predicates(self):
+        """Get the SQL predicates selecting the messages.
+
+        They use the `message` and `chat` tables, so apply to any query
+        joining those.
+
+        :Returns:
+            A tuple of a list of predicates (strings) to be joined with AND,
+            and a list of their parameters.
+        """
+        predicates = []
+        params = []
+        if self.chats:
+            predicates.append('chat.chat_identifier IN (%s)' % (
+                ', '.join('?' * len(self.chats)),))
+            params.extend(self.chats)
+        if self.contacts:
+            handle_predicates = []
+            for contact in self.contacts:
+                if '@' in contact:
+                    handle_predicates.append('handle.id = ? COLLATE NOCASE')
+                    params.append(contact)
+                else:
+                    # Handles have the country code, which may not be given.
+                    handle_predicates.append("handle.id LIKE ?")
+                    params.append('%' + get_digits(contact))
+            predicates.append(CONTACT_PREDICATE % (' OR '.join(handle_predicates),))
+        for date, op in [(self.since, '>='), (self.until, '<')]:
+            if date is not None:
+                predicates.append(DATE_PREDICATE % {'op': op})
+                params.extend([date, date * NANOSECONDS])
+        return predicates, params
+
+
+class MessageDatabase(object):
+    """Read access to the SMS SQLite DB of a backup.
+
+    A single read-only connection is used for all queries.  Handles and
+    attachments are joined to the messages in SQL, so each message row
+    carries everything needed to render it.
+    """
+
+    def __init__(self, filename, index, log, message_filter=None):
+        """
+        :Parameters:
+            - `filename`: Path to the SQLite DB file (as a string).
+            - `index`: `BackupIndex` used to name the attachments.
+            - `log`: Log object.
+            - `message_filter`: Optional `MessageFilter`.  Only the messages
+              it selects are read.
+
+        :Exceptions:
+            Standard exceptions from sqlite3 library.
+        """
+        self.filename = filename
+        self.index = index
+        self.log = log
+        self.message_filter = message_filter
+        self.conn = connect_read_only(filename)
+        self._has_last_exported = False
+
+    def close(self):
+        """Close the DB connection."""
+        self.conn.close()
+
+    def get_chat_contacts(self):
+        """Get the contacts in each chat.
+
+        :Returns:
+            A dictionary mapping a chat identifier (string) to a list of
+            contacts (phone number ('12223334444') or email as a string).
+
+        :Exceptions:
+            Standard exceptions from sqlite3 library.
+        """
+        sql = """SELECT chat.chat_identifier, LTRIM(handle.id, '+')
+        FROM `chat_handle_join`
+        INNER JOIN `chat`
+        ON chat_handle_join.chat_id=chat.ROWID
+        INNER JOIN `handle`
+        ON chat_handle_join.handle_id=handle.ROWID
+        ORDER BY chat_identifier ASC;"""
+        chat_contacts = {}
+        for chat_identifier, contact in self.conn.execute(sql):
+            chat_contacts.setdefault(chat_identifier, []).append(contact)
+        return chat_contacts
+
+    def iter_conversations(self, last_exported=None):
+        """Stream messages one chat at a time.
+
+        Rows are read from an ordered cursor rather than fetched all at once,
+        so only a single chat's messages are held in memory at any time.
+
+        :Parameters:
+            - `last_exported`: Optional dictionary mapping a chat identifier
+              (string) to the highest message ID (integer) already exported.
+              Only newer messages of those chats are read.
+
+        :Returns:
+            A generator yielding tuples of a chat identifier (string) and a
+            list of messages, as from `get_chat_messages`.
+
+        :Exceptions:
+            Standard exceptions from sqlite3 library.
+        """
+        current_chat = None
+        conversation = []
+        for message in self.iter_messages(last_exported):
+            if message.chat_identifier != current_chat:
+                if conversation:
+                    yield current_chat, conversation
+                current_chat = message.chat_identifier
+                conversation = []
+            conversation.append(message)
+        if conversation:
+            yield current_chat, conversation
+
+    def iter_messages(self, last_exported=None):
+        """Stream every message straight from the cursor, in chat order.
+
+        :Parameters:
+            - `last_exported`: Optional dictionary as for
+              `iter_conversations`.
+
+        :Returns:
+            A generator yielding `Message` tuples, ordered by chat identifier
+            and then message ID.
+
+        :Exceptions:
+            Standard exceptions from sqlite3 library.
+        """
+        return self._iter_messages(*self._where(last_exported))
+
+    def get_chat_messages(self, chat_identifier, after_message_id=0):
+        """Get the messages of a single chat.
+
+        :Parameters:
+            - `chat_identifier`: The chat to load (string).
+            - `after_message_id`: Only messages with a higher ID are loaded.
+
+        :Returns:
+            A list of `Message` tuples, in message ID order.  Dates are in
+            seconds.
+
+        :Exceptions:
+            Standard exceptions from sqlite3 library.
+        """
+        return list(self._iter_messages(*self._where(
+            predicates=['chat.chat_identifier=? AND message.ROWID>?'],
+            params=[chat_identifier, after_message_id])))
+
+    def get_chat_message_counts(self, last_exported=None):
+        """Get the number of messages in each chat.
+
+        :Parameters:
+            - `last_exported`: Optional dictionary as for
+              `iter_conversations`.  Only newer messages are counted.
+
+        :Returns:
+            A list of tuples of chat identifier (string) and message count
+            (integer), largest chats first.
+
+        :Exceptions:
+            Standard exceptions from sqlite3 library.
+        """
+        sql = """SELECT chat_identifier, COUNT(*)
+        FROM `message`
+        INNER JOIN `chat_message_join`
+        ON message.ROWID=chat_message_join.message_id
+        INNER JOIN `chat`
+        ON chat_message_join.chat_id=chat.ROWID
+        %s
+        GROUP BY chat_identifier
+        ORDER BY COUNT(*) DESC, chat_identifier ASC;"""
+        where, params = self._where(last_exported)
+        return self.conn.execute(sql % (where,), params).fetchall()
+
+    def _where(self, last_exported=None, predicates=(), params=()):
+        """Get the WHERE clause and its parameters for a message query.
+
+        :Parameters:
+            - `last_exported`: Optional dictionary as for
+              `iter_conversations`.
+            - `predicates`: Further predicates (strings) to select by.
+            - `params`: Parameters of `predicates`.
+
+        :Returns:
+            A tuple of the WHERE clause (string, empty if selecting every
+            message) and a list of its parameters.
+        """
+        predicates = list(predicates)
+        params = list(params)
+        if last_exported:
+            predicates.append(self._load_last_exported(last_exported))
+        if self.message_filter:
+            filter_predicates, filter_params = self.message_filter.get_predicates()
+            predicates.extend(filter_predicates)
+            params.extend(filter_params)
+        if not predicates:
+            return '', params
+        return 'WHERE ' + '\n    AND '.join(predicates), params
+
+    def _load_last_exported(self, last_exported):
+        """Load `last_exported` into a temp table and get the predicate."""
+        if self._has_last_exported:
+            self.conn.execute("DELETE FROM temp.last_exported;")
+        else:
+            self.conn.execute("""CREATE TEMP TABLE last_exported
+            (chat_identifier TEXT PRIMARY KEY, message_id INTEGER);""")
+            self._has_last_exported = True
+        self.conn.executemany("INSERT INTO temp.last_exported VALUES (?, ?);",
+                              last_exported.iteritems())
+        return LAST_EXPORTED_PREDICATE
+
+    def _iter_messages(self, where, params=()):
+        c = self.conn.cursor()
+        c.execute(MESSAGE_SQL % (where,), (ATTACHMENT_SEPARATOR,) + tuple(params))
+        make_message = Message._make
+        for message_row in c:
+            if message_row[-1] is None:
+                yield make_message(message_row)
+            else:
+                yield make_message(message_row[:-1] +
+                                   (self._split_attachments(message_row[-1]),))
+
+    def _split_attachments(self, filenames):
+        attachments = []
+        for filename in filenames.split(ATTACHMENT_SEPARATOR):
+            attachment_filename = self.index.get_file_id(
+                get_attachment_domain_path(filename, self.log))
+            attachments.append((attachment_filename, os.path.basename(filename)))
+        return attachments
 
 
 def normalize_phone_number(phone_number):
@@ -288,56 +615,213 @@ def get_contacts_map(filename, log):
     """
     contacts_map = {}
 
-    sql = """SELECT ABMultiValue.value AS Email, ABPerson.first AS FirstName,
+    # Property 3 is a phone number and 4 an email address.
+    sql = """SELECT ABMultiValue.property AS Property,
+    ABMultiValue.value AS Value, ABPerson.first AS FirstName,
     ABPerson.last AS LastName, ABPerson.organization as Organization
     FROM ABMultiValue
     LEFT JOIN ABPerson ON ABMultiValue.record_id = ABPerson.ROWID
-    WHERE ABMultiValue.property = 4;"""
-    conn = sqlite3.connect(filename)
-    c = conn.cursor()
-    c.execute(sql)
-    result = c.fetchall()
-    conn.close()
-    for email, first, last, org in result:
+    WHERE ABMultiValue.property IN (3, 4);"""
+    conn = connect_read_only(filename)
+    try:
+        result = conn.execute(sql).fetchall()
+    finally:
+        conn.close()
+    # Emails first, so a phone number wins over an email that is the same.
+    for prop, value, first, last, org in sorted(result, key=lambda row: -row[0]):
         names = [name for name in [first, last] if name is not None]
         if not names:
             contact = org
         else:
             contact = ' '.join(names)
-        contacts_map[email] = contact
-
-    sql = """SELECT ABMultiValue.value AS Number, ABPerson.first AS FirstName,
-    ABPerson.last AS LastName, ABPerson.organization as Organization
-    FROM ABMultiValue
-    LEFT JOIN ABPerson ON ABMultiValue.record_id = ABPerson.ROWID
-    WHERE ABMultiValue.property = 3;"""
-    conn = sqlite3.connect(filename)
-    c = conn.cursor()
-    c.execute(sql)
-    result = c.fetchall()
-    conn.close()
-    for number, first, last, org in result:
-        names = [name for name in [first, last] if name is not None]
-        if not names:
-            contact = org
-        else:
-            contact = ' '.join(names)
-        contacts_map[normalize_phone_number(number)] = contact
+        if prop == 3:
+            value = normalize_phone_number(value)
+        contacts_map[value] = contact
 
     return contacts_map
 
 
+class ContactResolver(object):
+    """Maps phone numbers and email addresses from messages to contact names.
+
+    Besides exact matches on email addresses and normalized phone numbers, a
+    number is matched on its last 10 digits, so numbers stored with or
+    without a country code are still found.  A number without an area code
+    (7 digits) only matches another without one, never the end of a full
+    number, which could be anyone's.  A key shared by contacts with different
+    names is not used.  Resolutions are
+    memoized, and the compiled index can be cached on disk, keyed on the
+    AddressBook DBs' sizes and mtimes.
+    """
+
+    def __init__(self, contacts_map):
+        """
+        :Parameters:
+            - `contacts_map`: Dictionary as from `get_contacts_map`.
+        """
+        self.exact = dict(contacts_map)
+        # Keys as from `get_suffix_key` to a name, or None when ambiguous.
+        self.suffixes = {}
+        for contact, name in contacts_map.iteritems():
+            if '@' in contact:
+                continue
+            suffix = get_suffix_key(contact)
+            if suffix is None:
+                continue
+            if self.suffixes.get(suffix, name) != name:
+                name_for_suffix = None
+            else:
+                name_for_suffix = name
+            self.suffixes[suffix] = name_for_suffix
+        self._resolved = {}
+
+    @classmethod
+    def load(cls, filename, cache_file, log):
+        """Get the resolver for an AddressBook DB, using a cached index.
+
+        :Parameters:
+            - `filename`: Path to the AddressBook SQLite DB (string).
+            - `cache_file`: Path of the index cache (string), or None to not
+              cache.
+            - `log`: Log object.
+
+        :Returns:
+            A `ContactResolver`.
+
+        :Exceptions:
+            Standard exceptions from sqlite3 library.
+        """
+        return cls.load_all([filename], cache_file, log)
+
+    @classmethod
+    def load_all(cls, filenames, cache_file, log):
+        """Get a single resolver for several AddressBook DBs, as for `load`.
+
+        A contact in more than one DB takes its name from the first.
+
+        :Parameters:
+            - `filenames`: List of paths to AddressBook SQLite DBs (strings).
+            - `cache_file`: As for `load`.
+            - `log`: Log object.
+
+        :Returns:
+            A `ContactResolver`.
+
+        :Exceptions:
+            Standard exceptions from sqlite3 library.
+        """
+        # As it reads back from JSON, to compare with the cached key.
+        cache_key = [CONTACTS_CACHE_VERSION]
+        for filename in filenames:
+            stat = os.stat(filename)
+            path = os.path.abspath(filename).decode(sys.getfilesystemencoding() or 'utf8',
+                                                    'replace')
+            cache_key.append([path, stat.st_size, int(stat.st_mtime)])
+        if cache_file and os.access(cache_file, os.F_OK):
+            try:
+                # JSON rather than a pickle, as anyone able to write to the
+                # output directory could make a pickle run code.
+                with open(cache_file) as fh:
+                    cached = json.load(fh)
+                cached_key, exact, suffixes = cached['key'], cached['exact'], cached['suffixes']
+                if cached_key == cache_key:
+                    log.debug('Using cached contacts from %s.', cache_file)
+                    resolver = cls({})
+                    resolver.exact = exact
+                    resolver.suffixes = suffixes
+                    return resolver
+            except Exception as e:
+                log.warn('Ignoring unreadable contacts cache %s: %s', cache_file, e)
+        contacts_map = {}
+        for filename in reversed(filenames):
+            contacts_map.update(get_contacts_map(filename, log))
+        resolver = cls(contacts_map)
+        if cache_file:
+            with open(cache_file + '.tmp', 'w') as fh:
+                json.dump({'key': cache_key, 'exact': resolver.exact,
+                           'suffixes': resolver.suffixes}, fh)
+            os.rename(cache_file + '.tmp', cache_file)
+        return resolver
+
+    def resolve(self, contact):
+        """Get the name for a phone number or email address.
+
+        :Parameters:
+            - `contact`: Phone number or email from a handle (string).
+
+        :Returns:
+            The contact's name (string), or `contact` if it is not known.
+        """
+        try:
+            return self._resolved[contact]
+        except KeyError:
+            pass
+        name = self.exact.get(contact)
+        if name is None and '@' not in contact:
+            name = self.exact.get(normalize_phone_number(contact))
+            if name is None:
+                suffix = get_suffix_key(contact)
+                if suffix is not None:
+                    name = self.suffixes.get(suffix)
+        if name is None:
+            name = contact
+        self._resolved[contact] = name
+        return name
+
+def get_digits(value):
+    """Get just the digits of a string, as a string."""
+    return ''.join([char for char in value if char.isdigit()])
+
+def get_suffix_key(phone_number):
+    """Get the key a phone number is matched on by `ContactResolver` when
+    it has no exact match.
+
+    :Returns:
+        The last 10 digits of a full number, all the digits of a number
+        without an area code (7 digits), or None for other lengths.
+    """
+    digits = get_digits(phone_number)
+    if len(digits) >= FULL_NUMBER_DIGITS:
+        return digits[-FULL_NUMBER_DIGITS:]
+    if len(digits) == LOCAL_NUMBER_DIGITS:
+        return digits
+    return None
+
+def parse_date(value, end_of_day=False):
+    """Parse a local date as given on the command line.
+
+    :Parameters:
+        - `value`: The date, as 'YYYY-MM-DD' or 'YYYY-MM-DD HH:MM:SS'.
+        - `end_of_day`: If True and no time is given, the date is taken as
+          the end of the day (the start of the next day).
+
+    :Returns:
+        The date in seconds after the magic date (integer).
+
+    :Exceptions:
+        ValueError if the date is not in either format.
+    """
+    try:
+        date = time.strptime(value, '%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        date = time.strptime(value, '%Y-%m-%d')
+        if end_of_day:
+            # mktime normalizes the day, and the DST flag, past month ends.
+            date = date[:2] + (date.tm_mday + 1,) + date[3:8] + (-1,)
+    return int(time.mktime(date)) - MAGIC_DATE_NUMBER
+
+
 def parse_cmd_line():
     """Parse the options and arguments from the command line.
 
     :Returns:
         opts, args
     """
-    usage = "usage: %prog [options] <path to backup directory>"
+    usage = "usage: %prog [options] <path to backup directory> [...]"
     # Standard location is ~/Library/Application\ Support/MobileSync/Backup
     parser = optparse.OptionParser(usage=usage)
     parser.add_option('-o', '--outdir', dest='output_dir',
-                      help='Directory where the archive will be stored. [default: %default]',
+                      help='Directory where the archive will be stored.  With more than one backup, each has its own subdirectory, named after the backup directory. [default: %default]',
                       default='~/out')
     parser.add_option('-l', '--logfile', dest='log_file',
                       help='File to write logs. If unspecified, stdout.')
@@ -347,7 +831,92 @@ def parse_cmd_line():
     parser.add_option('-q', '--quiet', dest='quiet',
                       help='Turn off all logging. This beats all other log options.',
                       action="store_true", default=False)
+    parser.add_option('-j', '--jobs', dest='jobs', type='int',
+                      help='Number of chats to export in parallel, each in its own process. [default: %default]',
+                      default=1)
+    parser.add_option('-c', '--copy-threads', dest='copy_threads', type='int',
+                      help='Number of threads copying attachments, per process. [default: %default]',
+                      default=4)
+    parser.add_option('-i', '--incremental', dest='incremental',
+                      help='Only export messages newer than the previous incremental run into the output directory, appending to its chats.',
+                      action="store_true", default=False)
+    parser.add_option('-p', '--paginate', dest='paging',
+                      help='Split each chat into pages of this many messages, or "month" for a page per month, with an index page per chat and for the archive.')
+    parser.add_option('-s', '--stats', dest='stats_file',
+                      help='File to write stats of the export to as JSON: time spent in each stage (not counting stages within it), counts per chat, attachments copied and missing, and the slowest chats.')
+    parser.add_option('--progress', dest='progress', type='float',
+                      help='Log progress (messages per second and ETA) at most this many seconds apart.')
+    parser.add_option('--timezone', dest='timezone',
+                      help='Show times in this timezone (a name like Europe/Paris, or a POSIX TZ string) instead of the local one.  --since and --until are in it too.')
+    parser.add_option('--chat', dest='chats', action='append',
+                      help='Only export the chat with this identifier (as in the SMS DB).  Can be given more than once.')
+    parser.add_option('--contact', dest='contacts', action='append',
+                      help='Only export chats with this phone number or email in.  Can be given more than once.')
+    parser.add_option('--since', dest='since',
+                      help='Only export messages sent on or after this local date (YYYY-MM-DD or "YYYY-MM-DD HH:MM:SS").')
+    parser.add_option('--until', dest='until',
+                      help='Only export messages sent up to the end of this local date (YYYY-MM-DD), or up to but not including "YYYY-MM-DD HH:MM:SS".')
+    parser.add_option('-n', '--ndjson', dest='ndjson_file',
+                      help='Also write every message, one JSON object per line, to this file.  It is gzip compressed if the name ends in .gz.  With --incremental, only messages new since the last export are written.')
+    parser.add_option('--no-html', dest='html',
+                      help='Only write the --ndjson file, not the HTML archive.',
+                      action="store_false", default=True)
+    parser.add_option('-t', '--thumbnails', dest='thumbnail_size', type='int',
+                      help='Show image attachments as thumbnails of at most this many pixels wide or high, loaded lazily and linking to the full image.  Needs PIL (Pillow).')
+    parser.add_option('-r', '--journal', dest='journal',
+                      help='Journal finished chats and pages in the output directory, so an interrupted export resumes where it stopped when run again with the same options.',
+                      action="store_true", default=False)
+    parser.add_option('-z', '--container', dest='container_file',
+                      help='Write the archive into this zip or tar file (.zip, .tar, .tar.gz, .tgz or .tar.bz2) instead of the output directory, which only keeps the contacts cache and stats.  Zip files store media uncompressed.')
+    parser.add_option('-f', '--search-index', dest='search_index',
+                      help='Also write a full-text index of every message to %s in the output directory, for searching with search_archive.py.' % (SEARCH_DB_FILE_NAME,),
+                      action="store_true", default=False)
     opts, args = parser.parse_args()
+    if not args:
+        parser.error('A backup directory is required.')
+    if opts.copy_threads < 1:
+        parser.error('--copy-threads must be at least 1.')
+    if opts.progress is not None and opts.progress <= 0:
+        parser.error('--progress must be a number of seconds.')
+    if opts.timezone:
+        if not hasattr(time, 'tzset'):
+            parser.error('--timezone is not supported on this platform.')
+        # Worker processes inherit the timezone.
+        os.environ['TZ'] = opts.timezone
+        time.tzset()
+    for option, end_of_day in [('since', False), ('until', True)]:
+        if getattr(opts, option) is not None:
+            try:
+                setattr(opts, option, parse_date(getattr(opts, option), end_of_day))
+            except ValueError:
+                parser.error('--%s must be a date as YYYY-MM-DD or "YYYY-MM-DD HH:MM:SS".' % (option,))
+    if opts.thumbnail_size is not None:
+        if opts.thumbnail_size < 1:
+            parser.error('--thumbnails must be a number of pixels.')
+        if Image is None:
+            parser.error('--thumbnails needs PIL (Pillow) installed.')
+    if not opts.html:
+        if not opts.ndjson_file:
+            parser.error('--no-html needs --ndjson.')
+        if opts.incremental or opts.paging or opts.search_index:
+            parser.error('--no-html cannot be used with --incremental, --paginate or --search-index.')
+    if opts.container_file:
+        if opts.jobs > 1 or opts.incremental or opts.journal or not opts.html or len(args) > 1:
+            parser.error('--container cannot be used with --jobs, --incremental, --journal, --no-html or more than one backup.')
+        if not opts.container_file.lower().endswith(
+                tuple(['.zip'] + [extension for extension, mode in TAR_MODES])):
+            parser.error('--container must end in .zip, .tar, .tar.gz, .tgz or .tar.bz2.')
+    if opts.contacts:
+        for contact in opts.contacts:
+            if '@' not in contact and len(get_digits(contact)) < 7:
+                parser.error('--contact must be an email or a phone number: %s' % (contact,))
+    if opts.paging is not None and opts.paging != 'month':
+        try:
+            opts.paging = int(opts.paging)
+        except ValueError:
+            parser.error('--paginate must be a number of messages or "month".')
+        if opts.paging < 1:
+            parser.error('--paginate must be a number of messages or "month".')
     return opts, args
 
 
@@ -379,6 +948,2125 @@ HTML_END = """
     </body>
 </html>
 """
+INDEX_HTML_START = """
+<html>
+    <head>
+    <title>%s</title>
+    <style>
+        td {padding: 0 10 0 10;}
+    </style>
+    </head>
+    <body>
+    <h1>%s</h1>
+    <table>
+"""
+INDEX_HTML_END = """
+    </table>
+    </body>
+</html>
+"""
+
+
+def load_manifest(destination_dir, log):
+    """Load the manifest of a previous incremental export.
+
+    :Parameters:
+        - `destination_dir`: The archive directory (string).
+        - `log`: Log object.
+
+    :Returns:
+        A dictionary mapping a chat identifier (string) to a dictionary with
+        the chat's 'filebase' (string), 'title' (the contact names as a
+        string), 'paging' (as the --paginate option), 'last_message_id'
+        (integer), 'message_count' (integer), 'pages' (list of dictionaries
+        as described in `export_conversation`) and 'attachments' (list of the
+        attachment filenames already copied).  It is empty if there is no
+        manifest yet.
+
+    :Exceptions:
+        Standard exceptions from json library for a corrupt manifest.
+    """
+    manifest_file = os.path.join(destination_dir, MANIFEST_FILE_NAME)
+    if not os.access(manifest_file, os.F_OK):
+        log.info('No manifest found; exporting all messages.')
+        return {}
+    with open(manifest_file) as fh:
+        return json.load(fh)['chats']
+
+def save_manifest(destination_dir, manifest, log):
+    """Write the manifest of an incremental export.
+
+    The manifest is written to a temporary file first and renamed into
+    place, so an interrupted write leaves the previous manifest intact.
+
+    :Parameters:
+        - `destination_dir`: The archive directory (string).
+        - `manifest`: Dictionary as returned by `load_manifest`.
+        - `log`: Log object.
+
+    :Returns:
+        None.
+    """
+    manifest_file = os.path.join(destination_dir, MANIFEST_FILE_NAME)
+    with open(manifest_file + '.tmp', 'w') as fh:
+        json.dump({'version': 1, 'chats': manifest}, fh, sort_keys=True)
+    os.rename(manifest_file + '.tmp', manifest_file)
+
+def load_ndjson_marks(destination_dir):
+    """Load the last message of each chat written to NDJSON by a previous
+    incremental export.
+
+    These are kept apart from the manifest, which is saved even when the
+    export fails, so messages are only left out of the next NDJSON delta once
+    a file holding them is in place.
+
+    :Parameters:
+        - `destination_dir`: The archive directory (string).
+
+    :Returns:
+        A dictionary as for `MessageDatabase.iter_conversations`, empty if no
+        NDJSON was written yet.
+
+    :Exceptions:
+        Standard exceptions from json library for a corrupt file.
+    """
+    marks_file = os.path.join(destination_dir, NDJSON_MARKS_FILE_NAME)
+    if not os.access(marks_file, os.F_OK):
+        return {}
+    with open(marks_file) as fh:
+        return json.load(fh)['chats']
+
+def save_ndjson_marks(destination_dir, marks):
+    """Write the marks of an incremental NDJSON export, as for `save_manifest`.
+
+    :Parameters:
+        - `destination_dir`: The archive directory (string).
+        - `marks`: Dictionary as returned by `load_ndjson_marks`.
+
+    :Returns:
+        None.
+    """
+    marks_file = os.path.join(destination_dir, NDJSON_MARKS_FILE_NAME)
+    with open(marks_file + '.tmp', 'w') as fh:
+        json.dump({'version': 1, 'chats': marks}, fh, sort_keys=True)
+    os.rename(marks_file + '.tmp', marks_file)
+
+def open_chat_for_append(filepath, size=None):
+    """Open an existing chat HTML file to append more messages to it.
+
+    The closing HTML is removed; the caller writes it again when finished.
+    Without a `size`, a file not ending in the closing HTML is refused.
+
+    :Parameters:
+        - `filepath`: Path to the chat HTML file (string).
+        - `size`: Optional size in bytes of the file up to the end of its
+          last message, as recorded when it was last exported.  The file is
+          truncated to it, removing the closing HTML and anything an
+          interrupted export appended after it.
+
+    :Returns:
+        The open file object, positioned at the end of the last message.
+
+    :Exceptions:
+        IOError if the file cannot be opened.  ValueError if the file is
+        shorter than `size`, or without one doesn't end in `HTML_END`, as it
+        would after an interrupted export.
+    """
+    fh = open(filepath, 'r+b')
+    fh.seek(0, os.SEEK_END)
+    if size is not None:
+        if fh.tell() >= size:
+            fh.truncate(size)
+            fh.seek(0, os.SEEK_END)
+            return fh
+    elif fh.tell() >= len(HTML_END):
+        fh.seek(-len(HTML_END), os.SEEK_END)
+        if fh.read() == HTML_END:
+            fh.seek(-len(HTML_END), os.SEEK_END)
+            fh.truncate()
+            return fh
+    fh.close()
+    raise ValueError('Chat file is incomplete: %s' % (filepath,))
+
+class AtomicFile(object):
+    """A file written under a temporary name and renamed into place when
+    closed, so it is never seen half written."""
+
+    def __init__(self, filename, fh=None):
+        """
+        :Parameters:
+            - `filename`: Path the file should end up at (string).
+            - `fh`: Optional file object already open on `filename` plus
+              '.tmp'.  By default that file is created.
+        """
+        self.filename = filename
+        self.tmp = filename + '.tmp'
+        self._fh = fh or open(self.tmp, mode='w')
+
+    def write(self, data):
+        self._fh.write(data)
+
+    def close(self):
+        self._fh.close()
+        os.rename(self.tmp, self.filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def load_journal(destination_dir, options, log):
+    """Load the journal of an interrupted export, to resume it.
+
+    The journal is a header naming the options of the export, and a file of
+    chat entries from each process that exported chats.  A journal from an
+    export with different options can't be resumed, so it is removed.
+
+    :Parameters:
+        - `destination_dir`: The archive directory (string).
+        - `options`: Dictionary of the options that change the output.
+        - `log`: Log object.
+
+    :Returns:
+        A dictionary mapping a chat identifier (string) to its manifest
+        entry, as described in `load_manifest`, for every chat finished or
+        partly exported.  It is empty if there is nothing to resume.
+    """
+    header_file = os.path.join(destination_dir, JOURNAL_FILE_NAME)
+    header = {'version': JOURNAL_VERSION, 'options': options}
+    if os.access(header_file, os.F_OK):
+        with open(header_file) as fh:
+            previous_header = json.load(fh)
+        if previous_header != json.loads(json.dumps(header)):
+            log.warning('Not resuming the export journaled with other options; starting again.')
+            remove_journal(destination_dir)
+    if not os.access(header_file, os.F_OK):
+        with open(header_file + '.tmp', 'w') as fh:
+            json.dump(header, fh, sort_keys=True)
+        os.rename(header_file + '.tmp', header_file)
+        return {}
+    entries = {}
+    for filename in os.listdir(destination_dir):
+        if not filename.startswith(JOURNAL_FILE_NAME + '.'):
+            continue
+        with open(os.path.join(destination_dir, filename)) as fh:
+            for line in fh:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Cut off by the interruption.
+                    continue
+                entry = record['entry']
+                previous = entries.get(record['chat'])
+                if previous is None or entry['last_message_id'] > previous['last_message_id']:
+                    entries[record['chat']] = entry
+    log.info('Resuming the journaled export of %d chats.', len(entries))
+    return entries
+
+def remove_journal(destination_dir):
+    """Remove the journal of an export, once it has finished."""
+    for filename in os.listdir(destination_dir):
+        if filename == JOURNAL_FILE_NAME or filename.startswith(JOURNAL_FILE_NAME + '.'):
+            os.remove(os.path.join(destination_dir, filename))
+
+
+class ExportJournal(object):
+    """Records the chats, and pages of chats, finished by this process.
+
+    Each process appends to its own file, so no locking is needed, and every
+    record is synced to disk before the export moves on.
+    """
+
+    def __init__(self, destination_dir):
+        """
+        :Parameters:
+            - `destination_dir`: The archive directory (string).
+        """
+        self.filename = os.path.join(destination_dir, '%s.%d' % (JOURNAL_FILE_NAME, os.getpid()))
+        self._fh = open(self.filename, 'a')
+
+    def record(self, id, entry):
+        """Record a chat's manifest entry after a page of it is finished.
+
+        :Parameters:
+            - `id`: The chat identifier (string).
+            - `entry`: The chat's manifest entry so far, as from
+              `make_manifest_entry`.
+        """
+        self._fh.write(json.dumps({'chat': id, 'entry': entry}, sort_keys=True) + '\n')
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+
+    def close(self):
+        """Close the journal file."""
+        self._fh.close()
+
+
+def load_content_digests(destination_dir):
+    """Load the content digests of backup files worked out by earlier exports
+    into a shared attachment pool.
+
+    Each process appends the digests it works out to a file of its own, as
+    for `ExportJournal`; they are merged back into one file here.
+
+    :Parameters:
+        - `destination_dir`: The archive directory (string).
+
+    :Returns:
+        A dictionary mapping a backup file's (path, size, mtime) to the SHA1
+        of its contents (hex string).
+    """
+    digests = {}
+    filenames = sorted(filename for filename in os.listdir(destination_dir)
+                       if filename == CONTENT_DIGESTS_FILE_NAME or
+                       filename.startswith(CONTENT_DIGESTS_FILE_NAME + '.'))
+    for filename in filenames:
+        with open(os.path.join(destination_dir, filename)) as fh:
+            for line in fh:
+                try:
+                    path, size, mtime, digest = json.loads(line)
+                except ValueError:
+                    # Cut off by an interrupted export.
+                    continue
+                digests[(path.encode('utf-8'), size, mtime)] = digest
+    digests_file = os.path.join(destination_dir, CONTENT_DIGESTS_FILE_NAME)
+    with open(digests_file + '.tmp', 'w') as fh:
+        for (path, size, mtime), digest in digests.iteritems():
+            fh.write(json.dumps([path, size, mtime, digest]) + '\n')
+    os.rename(digests_file + '.tmp', digests_file)
+    for filename in filenames:
+        if filename != CONTENT_DIGESTS_FILE_NAME:
+            os.remove(os.path.join(destination_dir, filename))
+    return digests
+
+def remove_stale_copies(directory):
+    """Remove the temporary files of copies cut off by an interrupted export.
+
+    :Parameters:
+        - `directory`: Path to the directory (string).  Nothing is done if it
+          doesn't exist.
+    """
+    if not os.path.isdir(directory):
+        return
+    for filename in os.listdir(directory):
+        if filename.endswith('.tmp'):
+            os.remove(os.path.join(directory, filename))
+
+def copy_atomically(file_from, file_to):
+    """Copy a file, with its mtime, under a temporary name and rename it into
+    place, so other threads and processes never see a partial copy.  A copy
+    cut off by an interrupted export is overwritten by the next one."""
+    tmp = file_to + '.tmp'
+    shutil.copyfile(file_from, tmp)
+    shutil.copystat(file_from, tmp)
+    os.rename(tmp, file_to)
+
+def lock_temporary_file(file_to):
+    """Create the temporary file of a copy exclusively, so it also locks the
+    copy between processes.
+
+    One left by an interrupted export must be removed with
+    `remove_stale_copies` first.
+
+    :Parameters:
+        - `file_to`: Path the copy will have (string).
+
+    :Returns:
+        The path of the temporary file (string), or None if another process
+        is making the copy.
+    """
+    tmp = file_to + '.tmp'
+    try:
+        os.close(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+        return None
+    return tmp
+
+def copy_exclusively(file_from, file_to):
+    """Copy a file as for `copy_atomically`, unless another process is
+    already copying it, as for `lock_temporary_file`.
+
+    :Parameters:
+        - `file_from`: Path to the file (string).
+        - `file_to`: Path to copy it to (string).
+
+    :Returns:
+        True once copied, or False if another process is copying it.
+    """
+    tmp = lock_temporary_file(file_to)
+    if tmp is None:
+        return False
+    try:
+        shutil.copyfile(file_from, tmp)
+        shutil.copystat(file_from, tmp)
+        os.rename(tmp, file_to)
+    except:
+        os.remove(tmp)
+        raise
+    return True
+
+def same_file_stat(path_a, path_b):
+    """Check whether two files look the same by size and modification time.
+
+    :Parameters:
+        - `path_a`: Path to a file (string).
+        - `path_b`: Path to another file (string).
+
+    :Returns:
+        True if both exist with the same size and whole-second mtime.
+    """
+    try:
+        stat_a = os.stat(path_a)
+        stat_b = os.stat(path_b)
+    except OSError:
+        return False
+    return (stat_a.st_size == stat_b.st_size and
+            int(stat_a.st_mtime) == int(stat_b.st_mtime))
+
+
+class AttachmentCopier(object):
+    """Copies attachments on a thread pool while chats are being rendered.
+
+    Each backup file is copied once into a pool directory in the archive,
+    named by its hashed backup name, and hard linked from there into every
+    chat directory that uses it.  Files whose size and mtime already match
+    are not copied again, so attachments forwarded into several chats, or
+    already archived by an earlier run, cost a link at most.
+
+    Thumbnails of images are made by the same threads, and kept by hashed
+    backup name so they are only made again if the image changes.
+
+    A pool shared by the archives of several backups is keyed by the files'
+    contents instead, as the same hashed backup name can be a different file
+    on each device, and the same file a different name.  The digests are
+    kept in each archive, so later runs don't read every file again.
+
+    The pool only pays off where hard links work.  Once a link fails (FAT
+    and exFAT disks, many SMB mounts), attachments are copied straight from
+    the backup into each chat directory instead, without the pool.
+    """
+
+    def __init__(self, pool_dir, threads, log, thumbnail_dir=None, thumbnail_size=None,
+                 by_content=False, digests=None, digests_file=None):
+        """
+        :Parameters:
+            - `pool_dir`: Directory for the pooled copies (string).  It is
+              created if needed.
+            - `threads`: Number of copy threads (integer).
+            - `log`: Log object.
+            - `thumbnail_dir`: Optional directory for thumbnails (string).
+              It is created if needed.
+            - `thumbnail_size`: Largest width or height of a thumbnail, in
+              pixels (integer).  Required with `thumbnail_dir`.
+            - `by_content`: If True, pooled copies are named by the SHA1 of
+              their contents rather than their hashed backup names.
+            - `digests`: Optional dictionary of the digests already known,
+              as from `load_content_digests`.
+            - `digests_file`: Optional path of a file to append the digests
+              worked out to (string).
+        """
+        self.pool_dir = pool_dir
+        self.log = log
+        self.by_content = by_content
+        # (path, size, mtime) of a backup file to the SHA1 of its contents.
+        self._digests = digests if digests is not None else {}
+        self._digests_fh = open(digests_file, 'a') if digests_file else None
+        self._digests_lock = threading.Lock()
+        self.thumbnail_dir = thumbnail_dir
+        self.thumbnail_size = thumbnail_size
+        directories = [pool_dir]
+        if thumbnail_dir:
+            directories += [thumbnail_dir, os.path.join(thumbnail_dir, str(thumbnail_size))]
+        for directory in directories:
+            if directory and not os.access(directory, os.F_OK):
+                try:
+                    os.mkdir(directory)
+                except OSError:
+                    # Another worker process got there first.
+                    if not os.path.isdir(directory):
+                        raise
+        self._pool = multiprocessing.pool.ThreadPool(threads)
+        # Bounds the queue of copies so rendering can't run far ahead.
+        self._slots = threading.BoundedSemaphore(threads * 16)
+        self._pending = 0
+        self._pending_cond = threading.Condition()
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        self._stats = collections.Counter()
+        self._stats_lock = threading.Lock()
+        # Cleared once a hard link fails.
+        self._hard_links = True
+
+    def copy(self, file_from, hashed_name, file_to, thumbnail_name=None):
+        """Queue an attachment to be copied into a chat directory.
+
+        :Parameters:
+            - `file_from`: Path to the attachment in the backup (string).
+            - `hashed_name`: The attachment's hashed backup name (string).
+            - `file_to`: Path the attachment should have in the archive.
+            - `thumbnail_name`: Optional filename of a thumbnail to make in
+              the thumbnail directory, as from `get_thumbnail_name`.
+
+        :Returns:
+            None.  Failures are logged by the copy thread.
+        """
+        self._slots.acquire()
+        with self._pending_cond:
+            self._pending += 1
+        self._pool.apply_async(self._transfer, (file_from, hashed_name, file_to, thumbnail_name))
+
+    def wait(self):
+        """Block until every queued copy has finished."""
+        with self._pending_cond:
+            while self._pending:
+                self._pending_cond.wait(1)
+
+    def close(self):
+        """Wait for queued copies and stop the copy threads."""
+        self.wait()
+        self._pool.close()
+        self._pool.join()
+        if self._digests_fh:
+            self._digests_fh.close()
+
+    def take_stats(self):
+        """Get the copy counts so far and start counting again from zero.
+
+        :Returns:
+            A `collections.Counter` of 'bytes_copied', 'files_copied' (into
+            the pool, or into chat directories without hard links),
+            'files_linked' (into chat directories), 'files_skipped'
+            (already in place), 'copy_errors', 'thumbnails_made',
+            'thumbnail_errors' and 'copy_seconds' (summed over the copy
+            threads).
+        """
+        with self._stats_lock:
+            stats = self._stats
+            self._stats = collections.Counter()
+        return stats
+
+    def _count(self, **counts):
+        with self._stats_lock:
+            self._stats.update(counts)
+
+    def _content_digest(self, path):
+        """Get the SHA1 of a file's contents (hex string), remembering it."""
+        stat = os.stat(path)
+        key = (path, stat.st_size, int(stat.st_mtime))
+        digest = self._digests.get(key)
+        if digest is None:
+            sha1 = hashlib.sha1()
+            with open(path, 'rb') as fh:
+                for block in iter(lambda: fh.read(CONTENT_HASH_BLOCK_SIZE), ''):
+                    sha1.update(block)
+            digest = sha1.hexdigest()
+            self._digests[key] = digest
+            if self._digests_fh:
+                with self._digests_lock:
+                    self._digests_fh.write(json.dumps(list(key) + [digest]) + '\n')
+                    self._digests_fh.flush()
+        return digest
+
+    def _lock_for(self, hashed_name):
+        with self._locks_lock:
+            return self._locks.setdefault(hashed_name, threading.Lock())
+
+    def _transfer(self, file_from, hashed_name, file_to, thumbnail_name):
+        started = time.time()
+        try:
+            if thumbnail_name:
+                with self._lock_for(thumbnail_name):
+                    self._thumbnail(file_from, os.path.join(self.thumbnail_dir, thumbnail_name))
+            if os.access(file_to, os.F_OK):
+                if self._up_to_date(file_from, file_to):
+                    self._count(files_skipped=1)
+                    return
+                os.remove(file_to)
+            if self._hard_links and self._link_from_pool(file_from, hashed_name, file_to):
+                return
+            copy_atomically(file_from, file_to)
+            self._count(files_copied=1, bytes_copied=os.path.getsize(file_to))
+        except Exception as e:
+            self._count(copy_errors=1)
+            self.log.exception('Unable to copy attachment %s to %s: %s',
+                               file_from, file_to, e)
+        finally:
+            self._count(copy_seconds=time.time() - started)
+            self._slots.release()
+            with self._pending_cond:
+                self._pending -= 1
+                self._pending_cond.notify_all()
+
+    def _up_to_date(self, file_from, file_to):
+        """Check whether an attachment in a chat directory is up to date."""
+        if same_file_stat(file_from, file_to):
+            return True
+        if not self.by_content:
+            return False
+        # Linked from a pooled copy with the mtime of whichever backup was
+        # archived first.
+        pooled = os.path.join(self.pool_dir, self._content_digest(file_from))
+        try:
+            return os.path.samefile(file_to, pooled)
+        except OSError:
+            return False
+
+    def _in_pool(self, file_from, pooled):
+        """Check whether the pooled copy of an attachment is up to date."""
+        if self.by_content:
+            # The same name is the same contents.
+            return os.access(pooled, os.F_OK)
+        return same_file_stat(file_from, pooled)
+
+    def _link_from_pool(self, file_from, hashed_name, file_to):
+        """Copy an attachment into the pool, if needed, and hard link it into
+        the chat directory.
+
+        :Returns:
+            True once linked, or False if hard links failed and the
+            attachment still has to be copied.
+        """
+        pool_name = self._content_digest(file_from) if self.by_content else hashed_name
+        pooled = os.path.join(self.pool_dir, pool_name)
+        copy_needed = False
+        with self._lock_for(pool_name):
+            while not self._in_pool(file_from, pooled):
+                if copy_exclusively(file_from, pooled):
+                    copy_needed = True
+                    self._count(files_copied=1, bytes_copied=os.path.getsize(pooled))
+                    break
+                # Another worker process is copying it.
+                time.sleep(COPY_WAIT_SECONDS)
+        try:
+            os.link(pooled, file_to)
+        except OSError as e:
+            if self._hard_links:
+                self._hard_links = False
+                self.log.warning('Unable to hard link attachments into %s, copying them '
+                                 'into each chat instead: %s', os.path.dirname(file_to), e)
+            # Nothing links to it, so it would only be a second copy.
+            if copy_needed:
+                with self._lock_for(pool_name):
+                    if os.access(pooled, os.F_OK):
+                        self._count(files_copied=-1, bytes_copied=-os.path.getsize(pooled))
+                        os.remove(pooled)
+            return False
+        self._count(files_linked=1)
+        return True
+
+    def _thumbnail(self, image, thumbnail):
+        """Make a thumbnail of an image, unless it is up to date."""
+        mtime = int(os.path.getmtime(image))
+        while not (os.access(thumbnail, os.F_OK) and
+                   int(os.path.getmtime(thumbnail)) == mtime):
+            tmp = lock_temporary_file(thumbnail)
+            if tmp is None:
+                # Another worker process is making it.
+                time.sleep(COPY_WAIT_SECONDS)
+                continue
+            try:
+                if write_thumbnail(image, tmp, thumbnail, self.thumbnail_size, self.log):
+                    self._count(thumbnails_made=1)
+                else:
+                    self._count(thumbnail_errors=1)
+                # Stamped with the image's mtime, to tell when it is out of date.
+                os.utime(tmp, (mtime, mtime))
+                os.rename(tmp, thumbnail)
+            except:
+                os.remove(tmp)
+                raise
+
+
+def get_thumbnail_name(hashed_name, extension, size):
+    """Get the filename of an attachment's thumbnail.
+
+    Thumbnails of each size go in their own subdirectory, so changing
+    --thumbnails makes new ones rather than reusing those of the old size.
+
+    :Parameters:
+        - `hashed_name`: The attachment's hashed backup name (string).
+        - `extension`: The attachment's extension, lower case, which must be
+          in `THUMBNAIL_EXTENSIONS`.
+        - `size`: Largest width or height of the thumbnail, in pixels.
+
+    :Returns:
+        The filename (string), relative to the thumbnail directory.
+    """
+    return os.path.join(str(size), '%s.%s' % (hashed_name, THUMBNAIL_EXTENSIONS[extension]))
+
+def make_thumbnail(file_from, file_to, size, image_format):
+    """Write a downscaled copy of an image.
+
+    :Parameters:
+        - `file_from`: Path to the image (string).
+        - `file_to`: Path to write the thumbnail to (string).
+        - `size`: Largest width or height of the thumbnail, in pixels.
+        - `image_format`: Format of the thumbnail, 'JPEG' or 'PNG'.
+
+    :Exceptions:
+        IOError or any other exception from PIL for an unreadable image.
+    """
+    image = Image.open(file_from)
+    # JPEGs are decoded at a reduced scale, far faster for large photos.
+    image.draft('RGB', (size, size))
+    image.thumbnail((size, size), Image.ANTIALIAS)
+    if image_format == 'JPEG':
+        image.convert('RGB').save(file_to, 'JPEG', quality=THUMBNAIL_JPEG_QUALITY)
+    else:
+        if image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+            image = image.convert('RGBA')
+        image.save(file_to, 'PNG', optimize=False)
+
+def write_thumbnail(file_from, file_to, thumbnail_name, size, log):
+    """Write a thumbnail of an image, or a copy of the image if it can't be
+    thumbnailed.
+
+    :Parameters:
+        - `file_from`: Path to the image (string).
+        - `file_to`: Path to write the thumbnail to (string).
+        - `thumbnail_name`: The thumbnail's name, as from
+          `get_thumbnail_name`, which sets its format.
+        - `size`: Largest width or height of the thumbnail, in pixels.
+        - `log`: Log object.
+
+    :Returns:
+        True if a thumbnail was made, or False if the image was copied.
+    """
+    try:
+        image_format = 'JPEG' if thumbnail_name.endswith('.jpg') else 'PNG'
+        make_thumbnail(file_from, file_to, size, image_format)
+        return True
+    except Exception as e:
+        # The page links the thumbnail, so the full image stands in.
+        log.warning('Unable to make a thumbnail of %s, using the image: %s', file_from, e)
+        shutil.copyfile(file_from, file_to)
+        return False
+
+
+class ZipContainer(object):
+    """A zip file the archive is written into, for --container."""
+
+    def __init__(self, filename):
+        """
+        :Parameters:
+            - `filename`: Path of the zip file to write (string).
+        """
+        self.zip = zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+
+    def add_file(self, path, arcname):
+        """Add a file to the container.
+
+        :Parameters:
+            - `path`: Path to the file (string).
+            - `arcname`: Path of the file in the container (string).
+        """
+        compress_type = zipfile.ZIP_DEFLATED
+        if arcname.rsplit('.', 1)[-1].lower() in STORED_EXTENSIONS:
+            compress_type = zipfile.ZIP_STORED
+        self.zip.write(path, arcname, compress_type)
+
+    def add_link(self, target_arcname, arcname, path):
+        """Add a file already in the container again under another name.
+
+        Zip files have no links, so the file is added again from `path`.
+        """
+        self.add_file(path, arcname)
+
+    def close(self):
+        """Finish writing the container."""
+        self.zip.close()
+
+
+class TarContainer(object):
+    """A tar file the archive is streamed into, for --container.
+
+    The tar file is written as a stream, never seeking, and is compressed as a
+    whole if its name asks for it.
+    """
+
+    def __init__(self, filename, mode):
+        """
+        :Parameters:
+            - `filename`: Path of the tar file to write (string).
+            - `mode`: The tarfile stream mode, as in `TAR_MODES`.
+        """
+        self.tar = tarfile.open(filename, mode)
+
+    def add_file(self, path, arcname):
+        """Add a file to the container, as for `ZipContainer.add_file`."""
+        self.tar.add(path, arcname, recursive=False)
+
+    def add_link(self, target_arcname, arcname, path):
+        """Add a file already in the container again, as a hard link."""
+        info = self.tar.gettarinfo(path, arcname)
+        info.type = tarfile.LNKTYPE
+        info.linkname = target_arcname
+        info.size = 0
+        self.tar.addfile(info)
+
+    def close(self):
+        """Finish writing the container."""
+        self.tar.close()
+
+
+def open_container(filename):
+    """Open a zip or tar container for writing, by its filename's extension.
+
+    :Parameters:
+        - `filename`: Path of the container (string), ending in .zip, .tar,
+          .tar.gz, .tgz or .tar.bz2.
+
+    :Returns:
+        A `ZipContainer` or `TarContainer`.
+
+    :Exceptions:
+        ValueError for any other extension, or IOError if the file can't be
+        created.
+    """
+    if filename.lower().endswith('.zip'):
+        return ZipContainer(filename)
+    for extension, mode in TAR_MODES:
+        if filename.lower().endswith(extension):
+            return TarContainer(filename, mode)
+    raise ValueError('Unknown container type: %s' % (filename,))
+
+
+class ContainerMember(object):
+    """A file being written into a container.
+
+    It is written to a temporary file, so its size is known, and added to the
+    container when closed.
+    """
+
+    def __init__(self, container, arcname):
+        self.container = container
+        self.arcname = arcname
+        # On local disk, not the container's storage.
+        self._fh = tempfile.NamedTemporaryFile(suffix='.tmp', delete=False)
+
+    def write(self, data):
+        self._fh.write(data)
+
+    def close(self):
+        self._fh.close()
+        try:
+            self.container.add_file(self._fh.name, self.arcname)
+        finally:
+            os.remove(self._fh.name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ContainerCopier(object):
+    """Adds attachments to a container, in place of an `AttachmentCopier`.
+
+    The container is a single stream, so attachments are added straight from
+    the backup as they are rendered.  Each backup file is added once, and
+    again only as a link where the container allows.  Thumbnails are made
+    into temporary files on a thread pool and added, in order, as they finish.
+    """
+
+    def __init__(self, container, destination_dir, log, thumbnail_size=None, threads=1):
+        """
+        :Parameters:
+            - `container`: The `ZipContainer` or `TarContainer`.
+            - `destination_dir`: The archive directory (string).  Paths
+              passed to `copy` are made relative to it.
+            - `log`: Log object.
+            - `thumbnail_size`: As for `AttachmentCopier`.
+            - `threads`: Number of threads making thumbnails.
+        """
+        self.container = container
+        self.destination_dir = destination_dir
+        self.log = log
+        self.thumbnail_size = thumbnail_size
+        # Hashed backup name to the path it was first added as.
+        self._added = {}
+        self._thumbnails = set()
+        self._stats = collections.Counter()
+        self._pool = None
+        if thumbnail_size:
+            self._pool = multiprocessing.pool.ThreadPool(threads)
+        # Thumbnails being made, as (arcname, temporary file, result), and
+        # how many may be at once, so rendering can't run far ahead.
+        self._pending = collections.deque()
+        self._max_pending = threads * 16
+
+    def copy(self, file_from, hashed_name, file_to, thumbnail_name=None):
+        """Add an attachment to the container, as for `AttachmentCopier.copy`."""
+        started = time.time()
+        try:
+            arcname = os.path.relpath(file_to, self.destination_dir)
+            if hashed_name in self._added:
+                self.container.add_link(self._added[hashed_name], arcname, file_from)
+                self._stats.update(files_linked=1)
+            else:
+                self.container.add_file(file_from, arcname)
+                self._added[hashed_name] = arcname
+                self._stats.update(files_copied=1, bytes_copied=os.path.getsize(file_from))
+            if thumbnail_name and thumbnail_name not in self._thumbnails:
+                self._thumbnail(file_from, thumbnail_name)
+                self._thumbnails.add(thumbnail_name)
+        except Exception as e:
+            self._stats.update(copy_errors=1)
+            self.log.exception('Unable to add attachment %s to the container as %s: %s',
+                               file_from, file_to, e)
+        finally:
+            self._stats.update(copy_seconds=time.time() - started)
+        self._add_thumbnails()
+
+    def _thumbnail(self, file_from, thumbnail_name):
+        """Start making a thumbnail on the thread pool."""
+        fh, tmp = tempfile.mkstemp(suffix='.tmp')
+        os.close(fh)
+        result = self._pool.apply_async(write_thumbnail, (file_from, tmp, thumbnail_name,
+                                                          self.thumbnail_size, self.log))
+        self._pending.append((os.path.join(THUMBNAIL_DIR_NAME, thumbnail_name), tmp, result))
+
+    def _add_thumbnails(self, wait=False):
+        """Add finished thumbnails to the container, in the order they were
+        started.
+
+        :Parameters:
+            - `wait`: Whether to wait for all of them, rather than only as
+              many as are over the limit.
+        """
+        while self._pending:
+            arcname, tmp, result = self._pending[0]
+            if not (wait or result.ready() or len(self._pending) > self._max_pending):
+                break
+            self._pending.popleft()
+            try:
+                if result.get():
+                    self._stats.update(thumbnails_made=1)
+                else:
+                    self._stats.update(thumbnail_errors=1)
+                self.container.add_file(tmp, arcname)
+            except Exception as e:
+                self._stats.update(thumbnail_errors=1)
+                self.log.exception('Unable to add thumbnail %s to the container: %s', arcname, e)
+            finally:
+                os.remove(tmp)
+
+    def wait(self):
+        """Wait for the thumbnails being made, and add them to the container."""
+        self._add_thumbnails(wait=True)
+
+    def close(self):
+        """Add the remaining thumbnails.  The container is closed by its owner."""
+        self.wait()
+        if self._pool:
+            self._pool.close()
+            self._pool.join()
+
+    def take_stats(self):
+        """Get the copy counts so far, as for `AttachmentCopier.take_stats`."""
+        stats = self._stats
+        self._stats = collections.Counter()
+        return stats
+
+
+SEARCH_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS message_search USING fts5(
+    sender, text, attachments, chat_title,
+    chat_identifier UNINDEXED, service UNINDEXED, date UNINDEXED, page UNINDEXED,
+    tokenize='unicode61 remove_diacritics 2');
+"""
+
+class SearchIndex(object):
+    """Full-text index of the exported messages, written for --search-index.
+
+    The index is an SQLite FTS5 table in the archive directory, with a row
+    per message keyed by the message's ROWID, so messages exported again are
+    replaced rather than duplicated.
+    """
+
+    def __init__(self, filename, log):
+        """
+        :Parameters:
+            - `filename`: Path to the index DB (string), created if missing.
+            - `log`: Log object.
+
+        :Exceptions:
+            sqlite3.OperationalError if SQLite was built without FTS5.
+        """
+        self.log = log
+        # Worker processes each write their own chats to the same DB.
+        self.conn = sqlite3.connect(filename, timeout=SEARCH_DB_TIMEOUT)
+        self.conn.executescript(SEARCH_SCHEMA)
+
+    def clear(self):
+        """Remove every message from the index."""
+        with self.conn:
+            self.conn.execute('DELETE FROM message_search;')
+
+    def add_messages(self, id, title, rows):
+        """Add the messages of a chat to the index.
+
+        :Parameters:
+            - `id`: The chat identifier (string).
+            - `title`: The chat's title (string).
+            - `rows`: List of tuples of the message ID, sender, text,
+              attachment names, service, date and page filename, as from
+              `get_search_row`.
+        """
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO message_search (rowid, sender, text, attachments, '
+                'service, date, page, chat_title, chat_identifier) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);',
+                [row + (title, id) for row in rows])
+
+    def close(self):
+        """Close the index DB."""
+        self.conn.close()
+
+def search_archive(destination_dir, query, limit=50):
+    """Search the full-text index of an archive.
+
+    :Parameters:
+        - `destination_dir`: The archive directory (string).
+        - `query`: An FTS5 query (string), e.g. 'dinner AND friday' or
+          'sender:alice'.
+        - `limit`: Maximum number of hits, best first.
+
+    :Returns:
+        A list of dictionaries of the 'chat_identifier', 'chat_title',
+        'sender', 'service', 'date' (seconds after the magic date), 'snippet'
+        of the text with the matches in brackets, and 'path' of the chat page
+        holding the message.
+
+    :Exceptions:
+        sqlite3.OperationalError for a bad query, or if the archive has no
+        search index.
+    """
+    filename = os.path.join(destination_dir, SEARCH_DB_FILE_NAME)
+    if not os.access(filename, os.F_OK):
+        raise sqlite3.OperationalError('No search index in %s.' % (destination_dir,))
+    conn = connect_read_only(filename)
+    try:
+        cursor = conn.execute(
+            "SELECT chat_identifier, chat_title, sender, service, date, "
+            "snippet(message_search, -1, '[', ']', '...', 16), page "
+            "FROM message_search WHERE message_search MATCH ? ORDER BY rank LIMIT ?;",
+            (query, limit))
+        return [{'chat_identifier': id, 'chat_title': title, 'sender': sender,
+                 'service': service, 'date': date, 'snippet': snippet,
+                 'path': os.path.join(destination_dir, page)}
+                for id, title, sender, service, date, snippet, page in cursor]
+    finally:
+        conn.close()
+
+
+class _TimedStage(object):
+    """Context manager adding the time spent in it to a `StageTimer`, less
+    the time spent in stages within it."""
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.nested_wall = 0.0
+        self.nested_cpu = 0.0
+        StageTimer.active.append(self)
+        self.wall = time.time()
+        self.cpu = time.clock()
+
+    def __exit__(self, *exc_info):
+        wall = time.time() - self.wall
+        cpu = time.clock() - self.cpu
+        StageTimer.active.pop()
+        self.timer.add(self.name, wall - self.nested_wall, cpu - self.nested_cpu)
+        if StageTimer.active:
+            outer = StageTimer.active[-1]
+            outer.nested_wall += wall
+            outer.nested_cpu += cpu
+
+
+class _UntimedStage(object):
+    """Context manager doing nothing, for when stats are not collected."""
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class StageTimer(object):
+    """Accumulates the wall and CPU time spent in named stages of an export.
+
+    Stages are exclusive: time spent in a stage within another, even of
+    another `StageTimer`, only counts for the inner stage.  So the stages of
+    a process add up to no more than its run time.  CPU time is for the whole
+    process, so it includes the copy threads.
+    """
+
+    # The `_TimedStage` objects entered in this process, innermost last.
+    # Stages are only timed by the main thread.
+    active = []
+
+    def __init__(self):
+        # Stage name to a list of wall seconds, CPU seconds and count.
+        self.stages = {}
+
+    def stage(self, name):
+        """Get a context manager timing a stage.
+
+        :Parameters:
+            - `name`: Name of the stage (string).  Time is added to any
+              already spent in a stage of the same name.
+        """
+        return _TimedStage(self, name)
+
+    def add(self, name, wall, cpu, count=1):
+        """Add time spent in a stage."""
+        times = self.stages.setdefault(name, [0.0, 0.0, 0])
+        times[0] += wall
+        times[1] += cpu
+        times[2] += count
+
+    def merge(self, stages):
+        """Add the stages of another `StageTimer`, as from `take`."""
+        for name, (wall, cpu, count) in stages.iteritems():
+            self.add(name, wall, cpu, count)
+
+    def take(self):
+        """Get the stages timed so far and start again from nothing."""
+        stages = self.stages
+        self.stages = {}
+        return stages
+
+
+class NullStageTimer(StageTimer):
+    """A `StageTimer` that doesn't time anything, so costs next to nothing."""
+
+    _untimed = _UntimedStage()
+
+    def stage(self, name):
+        return self._untimed
+
+
+class ProgressReporter(object):
+    """Logs the progress of an export, at most once per interval."""
+
+    def __init__(self, total_messages, interval, log):
+        """
+        :Parameters:
+            - `total_messages`: Number of messages to export (integer).
+            - `interval`: Minimum seconds between progress lines.
+            - `log`: Log object.
+        """
+        self.total_messages = total_messages
+        self.interval = interval
+        self.log = log
+        self.messages = 0
+        self.started = time.time()
+        self.last_report = self.started
+
+    def update(self, messages):
+        """Record exported messages, logging progress if it is time to."""
+        self.messages += messages
+        now = time.time()
+        if now - self.last_report < self.interval:
+            return
+        self.last_report = now
+        rate = self.messages / max(now - self.started, 0.001)
+        remaining = max(self.total_messages - self.messages, 0)
+        minutes, seconds = divmod(int(remaining / rate) if rate else 0, 60)
+        hours, minutes = divmod(minutes, 60)
+        eta = '%d:%02d:%02d' % (hours, minutes, seconds)
+        self.log.info('Exported %d of %d messages (%.1f%%), %.0f messages/s, ETA %s.',
+                      self.messages, self.total_messages,
+                      100.0 * self.messages / max(self.total_messages, 1), rate, eta)
+
+
+class RunStats(object):
+    """Statistics of an export, written as JSON by `main` for --stats."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.cpu_started = sum(os.times()[0:4])
+        self.timer = StageTimer()
+        # Chat identifier to the chat's stats, as from `get_chat_stats`.
+        self.chats = {}
+        self.copy_stats = collections.Counter()
+
+    def add_chat(self, id, chat_stats):
+        """Record the stats of an exported chat.
+
+        :Parameters:
+            - `id`: The chat identifier (string).
+            - `chat_stats`: As from `get_chat_stats`.  Its 'stages' and
+              'copy' are merged into the run's totals.
+        """
+        chat_stats = dict(chat_stats)
+        self.timer.merge(chat_stats.pop('stages', {}))
+        self.copy_stats.update(chat_stats.pop('copy', {}))
+        self.chats[id] = chat_stats
+
+    def report(self, slowest=10):
+        """Get the stats as a dictionary.
+
+        Stage times are exclusive, as in `StageTimer`.  With worker processes
+        they are summed over the processes, so they can add up to more than
+        the run took.
+
+        :Parameters:
+            - `slowest`: Number of the slowest chats to list.
+        """
+        totals = {'chats': len(self.chats)}
+        for key in ['messages', 'attachments', 'missing_attachments']:
+            totals[key] = sum(chat[key] for chat in self.chats.itervalues())
+        totals.update(self.copy_stats)
+        slowest_chats = sorted(self.chats.iteritems(),
+                               key=lambda item: item[1]['wall_seconds'],
+                               reverse=True)[:slowest]
+        return {'started': time.strftime('%Y-%m-%dT%H:%M:%S%z', time.localtime(self.started)),
+                'wall_seconds': time.time() - self.started,
+                # Includes worker processes, once they have exited.
+                'cpu_seconds': sum(os.times()[0:4]) - self.cpu_started,
+                'stages': dict((name, {'wall_seconds': wall, 'cpu_seconds': cpu, 'count': count})
+                               for name, (wall, cpu, count) in self.timer.stages.iteritems()),
+                'totals': totals,
+                'slowest_chats': [dict(chat, chat_identifier=id) for id, chat in slowest_chats],
+                'chats': self.chats}
+
+    def save(self, filename):
+        """Write the stats as JSON to a file."""
+        with open(filename, 'w') as fh:
+            json.dump(self.report(), fh, indent=2, sort_keys=True)
+
+
+class ArchiveContext(object):
+    """Data shared by every chat exported from a single backup.
+
+    This is created once in `main` and handed to each chat export, including
+    those run in worker processes.
+    """
+
+    def __init__(self, index, destination_dir, sms_db_file, chat_contacts,
+                 contacts, log, manifest=None, copy_threads=1,
+                 paging=None, collect_stats=False, search_index_file=None,
+                 message_filter=None, thumbnail_size=None, container=None,
+                 shared_pool_dir=None, journal=False, content_digests=None):
+        self.index = index
+        self.destination_dir = destination_dir
+        self.sms_db_file = sms_db_file
+        # Chat identifier to contacts, as from `MessageDatabase.get_chat_contacts`.
+        self.chat_contacts = chat_contacts
+        # The `ContactResolver` for names.
+        self.contacts = contacts
+        self.log = log
+        # Chats from a previous incremental export, as from `load_manifest`.
+        self.manifest = manifest or {}
+        self.copy_threads = copy_threads
+        # None, a number of messages per page or 'month'.
+        self.paging = paging
+        # Whether per-chat stats and stage times are collected, for --stats.
+        self.collect_stats = collect_stats
+        self.timer = StageTimer() if collect_stats else NullStageTimer()
+        # The `TimestampFormatter` for message times, in this process.
+        self.timestamps = TimestampFormatter()
+        # Path to the search index DB, if one is written.
+        self.search_index_file = search_index_file
+        # The `MessageFilter` selecting the messages to export, if any.
+        self.message_filter = message_filter
+        # Largest size of image thumbnails in pixels, or None for full size
+        # images.
+        self.thumbnail_size = thumbnail_size
+        # The `ZipContainer` or `TarContainer` the archive is written into,
+        # or None to write it into `destination_dir`.
+        self.container = container
+        # Attachment pool shared with the archives of other backups, keyed by
+        # content, or None for a pool of this archive's own.
+        self.shared_pool_dir = shared_pool_dir
+        # Content digests of this backup's files in the shared pool, as from
+        # `load_content_digests`.
+        self.content_digests = content_digests
+        # Whether finished chats and pages are journaled, for --journal.
+        self.journal = journal
+        # The `MessageDatabase`, `AttachmentCopier`, `SearchIndex` and
+        # `ExportJournal` of this process, set by `start`.  None can be shared
+        # with worker processes.
+        self.db = None
+        self.copier = None
+        self.search_index = None
+        self.journal_writer = None
+
+    def start(self, db=None):
+        """Open the DB and start the attachment copier for this process.
+
+        :Parameters:
+            - `db`: Optional `MessageDatabase` already opened by this process.
+        """
+        self.db = db or MessageDatabase(self.sms_db_file, self.index, self.log,
+                                        self.message_filter)
+        if self.container:
+            self.copier = ContainerCopier(self.container, self.destination_dir, self.log,
+                                          self.thumbnail_size, self.copy_threads)
+        else:
+            thumbnail_dir = None
+            if self.thumbnail_size:
+                thumbnail_dir = os.path.join(self.destination_dir, THUMBNAIL_DIR_NAME)
+            pool_dir = (self.shared_pool_dir or
+                        os.path.join(self.destination_dir, ATTACHMENT_POOL_DIR_NAME))
+            digests_file = None
+            if self.shared_pool_dir:
+                digests_file = os.path.join(self.destination_dir, '%s.%d' % (
+                    CONTENT_DIGESTS_FILE_NAME, os.getpid()))
+            self.copier = AttachmentCopier(pool_dir, self.copy_threads, self.log,
+                                           thumbnail_dir, self.thumbnail_size,
+                                           self.shared_pool_dir is not None,
+                                           self.content_digests, digests_file)
+        if self.search_index_file:
+            self.search_index = SearchIndex(self.search_index_file, self.log)
+        if self.journal:
+            self.journal_writer = ExportJournal(self.destination_dir)
+
+    def close(self):
+        """Wait for attachment copies and close the DBs."""
+        if self.copier:
+            self.copier.close()
+        if self.db:
+            self.db.close()
+        if self.search_index:
+            self.search_index.close()
+        if self.journal_writer:
+            self.journal_writer.close()
+
+    def open_output(self, filename):
+        """Open a file of the archive for writing.
+
+        :Parameters:
+            - `filename`: Path of the file, relative to the archive directory.
+
+        :Returns:
+            A file object, writing into the container if there is one.  A
+            file in the archive directory is only put in place once closed.
+        """
+        if self.container:
+            return ContainerMember(self.container, filename)
+        return AtomicFile(os.path.join(self.destination_dir, filename))
+
+    def open_output_for_append(self, filename, size=None):
+        """Open a chat page of the archive to append to, as for
+        `open_chat_for_append`.
+
+        When journaling, a copy of the page is appended to and renamed into
+        place once closed, so an interrupted export leaves the page as the
+        journal has it.
+        """
+        filepath = os.path.join(self.destination_dir, filename)
+        if not self.journal:
+            return open_chat_for_append(filepath, size)
+        shutil.copyfile(filepath, filepath + '.tmp')
+        try:
+            return AtomicFile(filepath, open_chat_for_append(filepath + '.tmp', size))
+        except ValueError:
+            os.remove(filepath + '.tmp')
+            raise
+
+    def get_page_size(self, filename):
+        """Get the size in bytes of a finished chat page of the archive, up to
+        the end of its last message, or None if it is in a container."""
+        if self.container:
+            return None
+        return os.path.getsize(os.path.join(self.destination_dir, filename)) - len(HTML_END)
+
+    def record_chat(self, id, entry):
+        """Journal a chat's entry once its finished pages, and their
+        attachments, are all on disk."""
+        if self.journal_writer:
+            self.copier.wait()
+            self.journal_writer.record(id, entry)
+
+
+def get_chat_contacts(id, context):
+    """Get the display names of the contacts in a chat.
+
+    :Parameters:
+        - `id`: The chat identifier (string).
+        - `context`: The `ArchiveContext` of the current run.
+
+    :Returns:
+        A list of contact names (strings), de-duplicated.
+    """
+    chat_contacts = [context.contacts.resolve(contact)
+                     for contact in context.chat_contacts.get(id, [])]
+    # Because unique contact IDs are created for both SMS and iMessage on
+    # the same phone number, these need to be de-duped.
+    return list(set(chat_contacts))
+
+def get_chat_filebase(id, chat_contacts):
+    """Get the base name used for a chat's HTML file and attachment directory.
+
+    :Parameters:
+        - `id`: The chat identifier (string).
+        - `chat_contacts`: List of contact names (strings) in the chat.
+
+    :Returns:
+        The base name (string), without any extension.
+    """
+    return '%s_%s' % (id, '_'.join(['-'.join(contact.split(' '))
+                                    for contact in chat_contacts]))
+
+
+class TimestampFormatter(object):
+    """Formats message dates in local time, as `time.strftime` does with
+    '%Y-%m-%d %H:%M:%S %Z', without a `time.localtime` call per message.
+
+    The date and zone name are looked up once per local day, and the time of
+    day is the seconds since its midnight, formatted from tables.  Days on
+    which the UTC offset changes (DST starting or ending) are not 24 hours
+    long and are not cached, so each of their dates is looked up on its own.
+    """
+
+    # 'HH:MM:' for each minute of the day and 'SS' for each second.
+    _MINUTES = ['%02d:%02d:' % divmod(minute, 60) for minute in range(24 * 60)]
+    _SECONDS = ['%02d' % (second,) for second in range(60)]
+
+    def __init__(self):
+        # Cached days, sorted by their start, as (start, end, date, zone)
+        # tuples: the Unix times of the midnights starting and ending the
+        # day, 'YYYY-MM-DD ' and ' ZONE'.
+        self._starts = []
+        self._days = []
+        # Hours (Unix time // 3600) already looked up, to their day.  An hour
+        # can span two days, so the day is checked before it is used.
+        self._hours = {}
+        # The day of the last date formatted, as dates mostly come in order.
+        self._last = None
+
+    def format(self, date):
+        """Format a message date (seconds after the magic date) as
+        'YYYY-MM-DD HH:MM:SS ZONE'."""
+        timestamp = int(MAGIC_DATE_NUMBER + date)
+        day = self._last
+        if day is None or not day[0] <= timestamp < day[1]:
+            day = self._hours.get(timestamp // 3600)
+            if day is None or not day[0] <= timestamp < day[1]:
+                day = self._get_day(timestamp)
+                if day is None:
+                    return time.strftime('%Y-%m-%d %H:%M:%S %Z', time.localtime(timestamp))
+            self._last = day
+        minute, second = divmod(timestamp - day[0], 60)
+        return day[2] + self._MINUTES[minute] + self._SECONDS[second] + day[3]
+
+    def format_day(self, date):
+        """Format a message date (seconds after the magic date) as 'YYYY-MM-DD'."""
+        timestamp = int(MAGIC_DATE_NUMBER + date)
+        day = self._get_day(timestamp)
+        if day is None:
+            return time.strftime('%Y-%m-%d', time.localtime(timestamp))
+        return day[2][:-1]
+
+    def _get_day(self, timestamp):
+        """Get the cached day of a Unix time, loading it if needed.
+
+        :Returns:
+            The day's tuple, or None if the UTC offset changes that day.
+        """
+        day = self._hours.get(timestamp // 3600)
+        if day is not None and day[0] <= timestamp < day[1]:
+            return day
+        n = bisect.bisect_right(self._starts, timestamp)
+        if n and timestamp < self._days[n - 1][1]:
+            day = self._days[n - 1]
+        else:
+            day = self._load_day(timestamp)
+            if day is None:
+                return None
+            self._starts.insert(n, day[0])
+            self._days.insert(n, day)
+        self._hours[timestamp // 3600] = day
+        return day
+
+    def _load_day(self, timestamp):
+        """Look up the local day of a Unix time.
+
+        :Returns:
+            The day's tuple, or None if the UTC offset changes that day.
+        """
+        local = time.localtime(timestamp)
+        start = timestamp - (local.tm_hour * 3600 + local.tm_min * 60 + local.tm_sec)
+        end = start + SECONDS_PER_DAY
+        # The day is cached only if it runs from midnight to 23:59:59 in
+        # exactly 24 hours, so the clock time is the seconds since `start`.
+        if (time.localtime(start)[:6] != local[:3] + (0, 0, 0) or
+                time.localtime(end - 1)[:6] != local[:3] + (23, 59, 59)):
+            return None
+        return (start, end, time.strftime('%Y-%m-%d ', local), time.strftime(' %Z', local))
+
+
+def get_message_times(message, timestamps):
+    """Format the times shown for a message.
+
+    :Parameters:
+        - `message`: The `Message`.
+        - `timestamps`: The `TimestampFormatter` of the current run.
+
+    :Returns:
+        A tuple of the sent time and the read time (strings), or None for the
+        read time if it is not shown.
+    """
+    read_time = None
+    if message.service == 'iMessage' and message.is_read == 1 and message.date_read != 0:
+        read_time = timestamps.format(message.date_read)
+    return timestamps.format(message.date), read_time
+
+def render_message(message, filebase, attachment_dir, copied, context, times=None):
+    """Render a single message as HTML, copying its attachments.
+
+    :Parameters:
+        - `message`: The `Message` to render.
+        - `filebase`: The base name of the chat (string), used for links.
+        - `attachment_dir`: Directory the chat's attachments are copied to.
+        - `copied`: Set of attachment filenames already in `attachment_dir`.
+          Those are not copied again and newly copied ones are added.
+        - `context`: The `ArchiveContext` of the current run.
+        - `times`: Optional tuple as from `get_message_times`, if already
+          formatted.
+
+    :Returns:
+        The HTML for the message (unicode).
+
+    :Exceptions:
+        Any exception from reading the message or copying its attachments.
+    """
+    message_parts = []
+    message_time_str, read_time_str = times or get_message_times(message, context.timestamps)
+
+    # Name and service:
+    if message.is_from_me:
+        my_string = '<dt class="sender_me">Me [%s]</dt>' % (message.service,)
+    else:
+        # A handle ID of 0, not in the handle table, has been seen since iOS 10.
+        contact = message.handle or 'me-or-null'
+        contact_name = context.contacts.resolve(contact)
+        my_string = '<dt class="sender_them">%s (%s) [%s]</dt>' % (contact_name, contact, message.service)
+    message_parts.append(my_string)
+
+    # Sent time and message text:
+    if message.text is None:
+        my_string = '<dd class="text">[%s] [no text]</dd>' % (message_time_str,)
+    else:
+        message_text = '<br>'.join(message.text.split('\n'))
+        my_string = '<dd class="text">[%s] %s</dd>' % (message_time_str, message_text)
+    message_parts.append(my_string)
+
+    # Attachments:
+    if message.attachments:
+        for attachment_filename, true_filename in message.attachments:
+            unique_filename = '%s-%s' % (attachment_filename, true_filename)
+            file_from = context.index.find(attachment_filename)
+            if file_from is None:
+                my_string = '<dd class="attachment">Missing attachment (%s).</dd>' % (unique_filename,)
+                message_parts.append(my_string)
+                continue
+            extension = unique_filename.split('.')[-1].lower()
+            thumbnail_name = None
+            if context.thumbnail_size and extension in THUMBNAIL_EXTENSIONS:
+                thumbnail_name = get_thumbnail_name(attachment_filename, extension,
+                                                    context.thumbnail_size)
+            if unique_filename not in copied:
+                file_to = os.path.join(attachment_dir, unique_filename)
+                context.copier.copy(file_from, attachment_filename, file_to, thumbnail_name)
+                copied.add(unique_filename)
+            file_link = os.path.join(filebase, unique_filename)
+            if thumbnail_name:
+                my_string = '<dd class="attachment"><a href="%s"><img src="%s" loading="lazy" /></a></dd>' % (
+                    file_link, os.path.join(THUMBNAIL_DIR_NAME, thumbnail_name))
+                message_parts.append(my_string)
+            elif extension in ['jpeg', 'jpg', 'png', 'gif', 'svg']:
+                my_string = '<dd class="attachment"><img src="%s" width=50%% /></dd>' % (file_link,)
+                message_parts.append(my_string)
+            my_string = '<dd class="attachment"><a href="%s">(%s)</a></dd>' % (file_link, unique_filename)
+            message_parts.append(my_string)
+
+    # Read time if applicable:
+    if read_time_str is not None:
+        my_string = '<dd class="readtime">Read at: %s</dd>' % (read_time_str,)
+        message_parts.append(my_string)
+
+    message_template = '<div class="message">\n%s\n</div>\n'
+    return message_template % ('\n'.join(message_parts),)
+
+def get_search_row(message, page_filename, context):
+    """Get a message's row for the search index.
+
+    :Parameters:
+        - `message`: The `Message`.
+        - `page_filename`: Filename of the chat page the message is on.
+        - `context`: The `ArchiveContext` of the current run.
+
+    :Returns:
+        A tuple as for `SearchIndex.add_messages`.
+    """
+    if message.is_from_me:
+        sender = u'Me'
+    else:
+        contact = message.handle or 'me-or-null'
+        sender = u'%s (%s)' % (context.contacts.resolve(contact), contact)
+    attachments = u' '.join(true_filename
+                            for attachment_filename, true_filename in message.attachments or [])
+    return (message.message_id, sender, message.text, attachments,
+            message.service, message.date, page_filename)
+
+def get_page_key(message, page, message_count, paging, timestamps):
+    """Get the key of the page a message belongs on.
+
+    :Parameters:
+        - `message`: The `Message`.
+        - `page`: The page the previous message went on (dictionary), or None.
+        - `message_count`: Number of messages in the chat before this one.
+        - `paging`: As in `ArchiveContext`.
+        - `timestamps`: The `TimestampFormatter` of the current run.
+
+    :Returns:
+        None when not paginating, the page number (integer, from 0) when
+        paginating by count, or the month ('YYYY-MM') when paginating by
+        month.
+    """
+    if paging is None:
+        return None
+    if paging == 'month':
+        key = timestamps.format_day(message.date)[:7]
+        # Messages are in ID order, which is not always date order; never go
+        # back to an earlier page.
+        if page is not None and key < page['key']:
+            key = page['key']
+        return key
+    return message_count // paging
+
+def get_page_filename(filebase, key, paging):
+    """Get the filename of a chat page.
+
+    :Parameters:
+        - `filebase`: The base name of the chat (string).
+        - `key`: The page key, as from `get_page_key`.
+        - `paging`: As in `ArchiveContext`.
+
+    :Returns:
+        The filename (string), relative to the archive directory.
+    """
+    if paging is None:
+        return filebase + '.html'
+    if paging == 'month':
+        return '%s_%s.html' % (filebase, key)
+    return '%s_page%04d.html' % (filebase, key + 1)
+
+def format_date(date):
+    """Format a message date (seconds after the magic date) as 'YYYY-MM-DD'."""
+    return time.strftime('%Y-%m-%d', time.localtime(MAGIC_DATE_NUMBER + date))
+
+def write_chat_index(entry, context):
+    """Write the index page of a paginated chat.
+
+    :Parameters:
+        - `entry`: The chat's manifest entry, as from `export_conversation`.
+        - `context`: The `ArchiveContext` of the current run.
+
+    :Returns:
+        None.
+    """
+    title = 'Conversation with %s' % (entry['title'],)
+    with context.open_output(entry['filebase'] + '.html') as fh:
+        fh.write((INDEX_HTML_START % (title, title)).encode('utf8'))
+        for page in entry['pages']:
+            if context.paging == 'month':
+                label = page['key']
+            else:
+                label = 'Page %d' % (page['key'] + 1,)
+            row = '<tr><td><a href="%s">%s</a></td><td>%s</td><td>%s</td><td>%d messages</td></tr>\n' % (
+                page['filename'], label, format_date(page['first_date']),
+                format_date(page['last_date']), page['count'])
+            fh.write(row.encode('utf8'))
+        fh.write(INDEX_HTML_END)
+
+def write_archive_index(manifest, context):
+    """Write the index page listing every chat in the archive.
+
+    :Parameters:
+        - `manifest`: Dictionary as returned by `load_manifest`.
+        - `context`: The `ArchiveContext` of the current run.
+
+    :Returns:
+        None.
+    """
+    title = 'Conversations'
+    with context.open_output('index.html') as fh:
+        fh.write(INDEX_HTML_START % (title, title))
+        for id, entry in sorted(manifest.iteritems()):
+            row = '<tr><td><a href="%s.html">%s</a></td><td>%s</td><td>%d messages</td></tr>\n' % (
+                entry['filebase'], id, entry['title'], entry['message_count'])
+            fh.write(row.encode('utf8'))
+        fh.write(INDEX_HTML_END)
+
+def export_conversation(id, conversation, context):
+    """Write the HTML pages and attachment directory for one chat.
+
+    Errors rendering a single message are logged and the message is skipped.
+    If the chat is in the manifest of a previous incremental export, the
+    messages are appended to its last page, or to new pages.
+
+    Without pagination, a chat has a single page named after its file base.
+    With pagination, each page has its own file and the file base names the
+    chat's index page.
+
+    :Parameters:
+        - `id`: The chat identifier (string).
+        - `conversation`: List of the `Message` tuples in the chat.
+        - `context`: The `ArchiveContext` of the current run.
+
+    :Returns:
+        The chat's manifest entry, as described in `load_manifest`.  Its
+        'pages' are dictionaries with the page's 'key' (as from
+        `get_page_key`), 'filename' (string), 'first_date' and 'last_date'
+        (seconds after the magic date), message 'count' (integer) and
+        'size' (as from `ArchiveContext.get_page_size`), which an
+        incremental export truncates the page back to before appending.
+    """
+    log = context.log
+    paging = context.paging
+    previous = context.manifest.get(id)
+    if previous:
+        if previous.get('paging') != paging:
+            log.error('Chat %s was archived with different pagination, skipping it.', id)
+            return previous
+        filebase = previous['filebase']
+        title = previous['title']
+        copied = set(previous['attachments'])
+        pages = [dict(page) for page in previous['pages']]
+        message_count = previous['message_count']
+    else:
+        chat_contacts = get_chat_contacts(id, context)
+        filebase = get_chat_filebase(id, chat_contacts)
+        title = ', '.join(chat_contacts)
+        copied = set()
+        pages = []
+        message_count = 0
+    attachment_dir = os.path.join(context.destination_dir, filebase)
+    search_rows = []
+    # Left by an earlier, interrupted export.
+    if not previous and not context.container and not os.path.isdir(attachment_dir):
+        os.mkdir(attachment_dir)
+
+    # Formatted for the whole chat at once, as timing each message would
+    # cost as much as formatting it.
+    times = []
+    with context.timer.stage('format timestamps'):
+        for message in conversation:
+            try:
+                times.append(get_message_times(message, context.timestamps))
+            except Exception:
+                # Raised again rendering the message, which is then skipped.
+                times.append(None)
+
+    # The previous export's last page is appended to if the first message
+    # belongs on it.
+    page = pages[-1] if pages else None
+    fh = None
+    try:
+        for message, message_times in itertools.izip(conversation, times):
+            key = get_page_key(message, page, message_count, paging, context.timestamps)
+            if fh is None or page['key'] != key:
+                if fh is not None:
+                    fh.write(HTML_END)
+                    fh.close()
+                    fh = None
+                    page['size'] = context.get_page_size(page['filename'])
+                    if context.journal:
+                        # The chat can be resumed from the next page.
+                        if search_rows:
+                            context.search_index.add_messages(id, title, search_rows)
+                            search_rows = []
+                        context.record_chat(id, make_manifest_entry(
+                            filebase, title, paging, last_message_id, message_count,
+                            pages, copied))
+                if page is not None and page['key'] == key:
+                    try:
+                        fh = context.open_output_for_append(page['filename'],
+                                                            page.get('size'))
+                    except (IOError, ValueError) as e:
+                        log.error('Unable to append to chat %s, skipping it: %s', id, e)
+                        return previous
+                else:
+                    page = {'key': key,
+                            'filename': get_page_filename(filebase, key, paging),
+                            'first_date': message.date,
+                            'last_date': message.date,
+                            'count': 0,
+                            'size': None}
+                    pages.append(page)
+                    fh = context.open_output(page['filename'])
+                    fh.write((HTML_START % (title,)).encode('utf8'))
+
+            try:
+                with context.timer.stage('render messages'):
+                    html = render_message(message, filebase, attachment_dir,
+                                          copied, context, message_times).encode('utf8')
+                with context.timer.stage('write html'):
+                    fh.write(html)
+            except Exception as e:
+                log.debug('An error occurred on message: %s', message)
+                log.exception('Unexpected error: %s', e)
+            if context.search_index:
+                search_rows.append(get_search_row(message, page['filename'], context))
+            page['count'] += 1
+            page['first_date'] = min(page['first_date'], message.date)
+            page['last_date'] = max(page['last_date'], message.date)
+            message_count += 1
+            last_message_id = message.message_id
+    finally:
+        if fh is not None:
+            fh.write(HTML_END)
+            fh.close()
+            page['size'] = context.get_page_size(page['filename'])
+
+    if search_rows:
+        with context.timer.stage('write search index'):
+            context.search_index.add_messages(id, title, search_rows)
+    entry = make_manifest_entry(filebase, title, paging, conversation[-1].message_id,
+                                message_count, pages, copied)
+    if paging is not None:
+        write_chat_index(entry, context)
+    context.record_chat(id, entry)
+    return entry
+
+def make_manifest_entry(filebase, title, paging, last_message_id, message_count,
+                        pages, copied):
+    """Get a chat's manifest entry, as described in `load_manifest`.
+
+    :Parameters:
+        - `filebase`: The base name of the chat (string).
+        - `title`: The chat's title (string).
+        - `paging`: As in `ArchiveContext`.
+        - `last_message_id`: ID of the last message exported (integer).
+        - `message_count`: Number of messages exported (integer).
+        - `pages`: List of the chat's pages, as described in
+          `export_conversation`.  They are copied.
+        - `copied`: Set of the attachment filenames copied.
+
+    :Returns:
+        The entry (dictionary).
+    """
+    return {'filebase': filebase,
+            'title': title,
+            'paging': paging,
+            'last_message_id': last_message_id,
+            'message_count': message_count,
+            'pages': [dict(page) for page in pages],
+            'attachments': sorted(copied)}
+
+def get_chat_stats(conversation, context, wall_seconds):
+    """Get the stats of an exported chat, for --stats.
+
+    :Parameters:
+        - `conversation`: List of the `Message` tuples exported.
+        - `context`: The `ArchiveContext` of the current run.
+        - `wall_seconds`: Time taken to export the chat.
+
+    :Returns:
+        A dictionary of the number of 'messages', 'attachments' and
+        'missing_attachments' and the 'wall_seconds', or None if stats are not
+        being collected.
+    """
+    if not context.collect_stats:
+        return None
+    attachments = 0
+    missing = 0
+    for message in conversation:
+        if message.attachments:
+            attachments += len(message.attachments)
+            missing += len([attachment_filename
+                            for attachment_filename, true_filename in message.attachments
+                            if context.index.find(attachment_filename) is None])
+    return {'messages': len(conversation), 'attachments': attachments,
+            'missing_attachments': missing, 'wall_seconds': wall_seconds}
+
+def export_conversations(context, last_exported=None):
+    """Export every chat, one at a time, streaming them from the DB.
+
+    :Parameters:
+        - `context`: The `ArchiveContext` of the current run.
+        - `last_exported`: Optional dictionary as for
+          `MessageDatabase.iter_conversations`.
+
+    :Returns:
+        A generator yielding tuples of chat identifier (string), manifest
+        entry (dictionary) and chat stats (as from `get_chat_stats`) as each
+        chat is finished.
+    """
+    conversations = context.db.iter_conversations(last_exported)
+    while True:
+        with context.timer.stage('load messages'):
+            try:
+                id, conversation = next(conversations)
+            except StopIteration:
+                return
+        started = time.time()
+        entry = export_conversation(id, conversation, context)
+        yield id, entry, get_chat_stats(conversation, context, time.time() - started)
+
+
+def export_backups(contexts, dbs, last_exported):
+    """Export every chat of several backups, one backup after another.
+
+    :Parameters:
+        - `contexts`: List of the `ArchiveContext` of each backup.
+        - `dbs`: List of each backup's open `MessageDatabase`.
+        - `last_exported`: List of each backup's dictionary as for
+          `MessageDatabase.iter_conversations`.
+
+    :Returns:
+        A generator yielding tuples of the backup's index in `contexts` and
+        the chat's tuple as from `export_conversations`.
+    """
+    for n, context in enumerate(contexts):
+        context.start(dbs[n])
+        for id, entry, chat_stats in export_conversations(context, last_exported[n]):
+            yield n, id, entry, chat_stats
+
+
+# Set in each worker process by `_init_export_worker`.
+_worker_contexts = None
+
+def _init_export_worker(contexts):
+    """Pool initializer storing the `ArchiveContext` list in the worker process."""
+    global _worker_contexts
+    _worker_contexts = contexts
+    # Inherited from the stage the pool was started in.
+    del StageTimer.active[:]
+
+def _export_chat_worker(task):
+    """Pool task loading and exporting a single chat, by backup index and
+    chat identifier."""
+    n, id = task
+    context = _worker_contexts[n]
+    if context.db is None:
+        # Only backups this worker is given chats from are opened.
+        context.start()
+    previous = context.manifest.get(id)
+    after_message_id = previous['last_message_id'] if previous else 0
+    with context.timer.stage('load messages'):
+        conversation = context.db.get_chat_messages(id, after_message_id)
+    if not conversation:
+        return n, id, previous, None
+    started = time.time()
+    entry = export_conversation(id, conversation, context)
+    # The copy threads die with the worker, so finish the chat's copies.
+    with context.timer.stage('wait for copies'):
+        context.copier.wait()
+    chat_stats = get_chat_stats(conversation, context, time.time() - started)
+    if chat_stats is not None:
+        # Only this process has these, so they go back with the chat.
+        chat_stats['stages'] = context.timer.take()
+        chat_stats['copy'] = context.copier.take_stats()
+    return n, id, entry, chat_stats
+
+def export_conversations_parallel(contexts, jobs, chat_counts):
+    """Export every chat of one or more backups using a pool of worker
+    processes.
+
+    Chats are scheduled largest first, across every backup, so a single huge
+    chat does not end up running alone at the end of the export.  Each worker
+    loads its chat from the DB itself, so only chat identifiers are passed
+    between processes.
+
+    :Parameters:
+        - `contexts`: List of the `ArchiveContext` of each backup.
+        - `jobs`: Number of worker processes (integer).
+        - `chat_counts`: The chats to export, as tuples of the backup's index
+          in `contexts`, chat identifier and message count, largest first.
+
+    :Returns:
+        A generator yielding tuples as from `export_backups`.
+
+    :Exceptions:
+        Any exception raised exporting a chat is re-raised here.
+    """
+    pool = multiprocessing.Pool(jobs, _init_export_worker, (contexts,))
+    try:
+        for n, id, entry, chat_stats in pool.imap_unordered(
+                _export_chat_worker, [(n, id) for n, id, count in chat_counts]):
+            contexts[n].log.debug('Finished chat: %s', id)
+            yield n, id, entry, chat_stats
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def format_utc_date(date):
+    """Format a message date (seconds after the magic date) as ISO 8601 UTC."""
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(MAGIC_DATE_NUMBER + date))
+
+def get_message_record(message, chat_contacts, filebase, context):
+    """Get a message as a dictionary for NDJSON output.
+
+    :Parameters:
+        - `message`: The `Message`.
+        - `chat_contacts`: List of the chat's contacts, as dictionaries of
+          'handle' and resolved 'name'.
+        - `filebase`: The chat's base name in the HTML archive (string), or
+          None if no HTML is written.
+        - `context`: The `ArchiveContext` of the current run.
+
+    :Returns:
+        A dictionary of the message's fields.  Dates are ISO 8601 UTC, and
+        attachments have their original 'name', 'backup_path' and
+        'archive_path' (relative to the archive directory, None without
+        HTML).  Both paths are None if the file is missing from the backup.
+    """
+    attachments = []
+    for attachment_filename, true_filename in message.attachments or []:
+        backup_path = context.index.find(attachment_filename)
+        archive_path = None
+        if filebase is not None and backup_path is not None:
+            archive_path = os.path.join(filebase, '%s-%s' % (attachment_filename, true_filename))
+        attachments.append({'name': true_filename,
+                            'backup_path': backup_path,
+                            'archive_path': archive_path})
+    handle = None
+    sender = None
+    if not message.is_from_me:
+        handle = message.handle
+        sender = context.contacts.resolve(handle or 'me-or-null')
+    return {'message_id': message.message_id,
+            'chat_identifier': message.chat_identifier,
+            'contacts': chat_contacts,
+            'is_from_me': bool(message.is_from_me),
+            'handle': handle,
+            'sender': sender,
+            'service': message.service,
+            'date': format_utc_date(message.date),
+            'date_read': format_utc_date(message.date_read) if message.date_read else None,
+            'text': message.text,
+            'attachments': attachments}
+
+def iter_message_records(db, context, last_exported=None, html=True, backup_name=None,
+                         exported=None):
+    """Stream every message as a record for NDJSON output.
+
+    Messages come straight from the DB cursor rather than a chat at a time,
+    so memory use is flat however many there are.
+
+    :Parameters:
+        - `db`: The `MessageDatabase` to read from.
+        - `context`: The `ArchiveContext` of the current run.
+        - `last_exported`: Optional dictionary as for
+          `MessageDatabase.iter_conversations`.
+        - `html`: Whether the HTML archive is written, for the attachments'
+          archive paths.
+        - `backup_name`: Optional name of the backup, added to each record
+          as 'backup'.
+        - `exported`: Optional dictionary updated with the ID of the last
+          message yielded from each chat.
+
+    :Returns:
+        A generator yielding dictionaries, as from `get_message_record`.
+    """
+    current_chat = None
+    for message in db.iter_messages(last_exported):
+        if message.chat_identifier != current_chat:
+            current_chat = message.chat_identifier
+            chat_contacts = [{'handle': contact, 'name': context.contacts.resolve(contact)}
+                             for contact in context.chat_contacts.get(current_chat, [])]
+            filebase = None
+            if html:
+                previous = context.manifest.get(current_chat)
+                if previous:
+                    filebase = previous['filebase']
+                else:
+                    filebase = get_chat_filebase(current_chat,
+                                                 get_chat_contacts(current_chat, context))
+        record = get_message_record(message, chat_contacts, filebase, context)
+        if backup_name is not None:
+            record['backup'] = backup_name
+        yield record
+        if exported is not None:
+            exported[current_chat] = message.message_id
+
+def write_ndjson(filename, records, log):
+    """Write records as newline delimited JSON.
+
+    The file is gzip compressed if its name ends in '.gz'.  It is written to
+    a temporary file first and renamed into place once complete, or removed
+    if writing fails.
+
+    :Parameters:
+        - `filename`: Path of the file to write (string).
+        - `records`: Iterable of dictionaries.
+        - `log`: Log object.
+
+    :Returns:
+        The number of records written (integer).
+
+    :Exceptions:
+        Any exception from `records` or writing the file.
+    """
+    tmp = filename + '.tmp'
+    raw_fh = open(tmp, 'wb')
+    fh = raw_fh
+    if filename.endswith('.gz'):
+        fh = gzip.GzipFile(os.path.basename(filename)[:-3], 'wb', NDJSON_GZIP_LEVEL, raw_fh)
+    count = 0
+    lines = []
+    try:
+        for record in records:
+            lines.append(json.dumps(record, separators=(',', ':')))
+            if len(lines) == NDJSON_BATCH_SIZE:
+                fh.write('\n'.join(lines) + '\n')
+                count += len(lines)
+                lines = []
+        if lines:
+            fh.write('\n'.join(lines) + '\n')
+            count += len(lines)
+    except:
+        fh.close()
+        raw_fh.close()
+        os.remove(tmp)
+        raise
+    fh.close()
+    # Closing a GzipFile leaves the file it wrote to open.
+    raw_fh.close()
+    os.rename(tmp, filename)
+    log.debug('Wrote %d messages to %s.', count, filename)
+    return count
+
+
+def get_backup_names(backup_dirs):
+    """Get a unique name for each backup, for its subtree of a batch archive.
+
+    :Parameters:
+        - `backup_dirs`: List of backup directories (strings).
+
+    :Returns:
+        A list of names (strings), from the directories' base names (the
+        device's UDID for iTunes backups).
+    """
+    names = []
+    for backup_dir in backup_dirs:
+        base = os.path.basename(os.path.normpath(os.path.abspath(backup_dir)))
+        name = base
+        suffix = 2
+        while name in names:
+            name = '%s_%d' % (base, suffix)
+            suffix += 1
+        names.append(name)
+    return names
 
 
 def main():
@@ -394,103 +3082,222 @@ def main():
         log.addHandler(logging.StreamHandler(sys.stdout))
     if opts.verbose:
         log.setLevel(logging.DEBUG)
-
-    # Paths from command line.
-    backup_dir = args[0]
-    sms_db_file = os.path.join(backup_dir, SMS_DB_FILE_NAME)
-    if not os.access(sms_db_file, os.F_OK):
-        sms_db_file = os.path.join(backup_dir, SMS_DB_FILE_NAME[0:2], SMS_DB_FILE_NAME)
-    contacts_db_file = os.path.join(backup_dir, CONTACTS_DB_FILE_NAME)
-    if not os.access(contacts_db_file, os.F_OK):
-        contacts_db_file = os.path.join(backup_dir, CONTACTS_DB_FILE_NAME[0:2], CONTACTS_DB_FILE_NAME)
-    destination_dir = opts.output_dir
+    elif opts.progress:
+        log.setLevel(logging.INFO)
+    stats = RunStats() if opts.stats_file else None
+    timer = stats.timer if stats else NullStageTimer()
+
+    # Paths from command line.  With more than one backup, each gets its own
+    # subtree of the output directory.
+    backup_dirs = args
+    batch = len(backup_dirs) > 1
+    output_dir = opts.output_dir
+    backup_names = get_backup_names(backup_dirs)
+    indexes = []
+    sms_db_files = []
+    contacts_db_files = []
+    for backup_dir in backup_dirs:
+        with timer.stage('index backup'):
+            index = BackupIndex(backup_dir, log)
+        sms_db_file = index.find(SMS_DB_FILE_NAME)
+        contacts_db_file = index.find(CONTACTS_DB_FILE_NAME)
+        if sms_db_file is None or contacts_db_file is None:
+            log.error('The SMS or contacts DB is missing from the backup: %s', backup_dir)
+            sys.exit(1)
+        indexes.append(index)
+        sms_db_files.append(sms_db_file)
+        contacts_db_files.append(contacts_db_file)
+    if batch:
+        destination_dirs = [os.path.join(output_dir, name) for name in backup_names]
+    else:
+        destination_dirs = [output_dir]
 
     # Someone didn't make the destination directory yet.
-    if not os.access(destination_dir, os.F_OK):
-        os.mkdir(destination_dir)
+    for destination_dir in [output_dir] + destination_dirs:
+        if not os.access(destination_dir, os.F_OK):
+            os.mkdir(destination_dir)
 
-    # SQLite data.
-    contacts_in_chat = get_contacts_in_chat(sms_db_file, log)
-    handle_contact_map = get_handle_to_contact(sms_db_file, log)
-    conversations = get_chat_coversations(sms_db_file, log)
-    attachments = get_message_attachments(sms_db_file, log)
-    contacts_map = get_contacts_map(contacts_db_file, log)
-
-    for id, conversation in conversations.iteritems():
-        chat_contacts = [handle_contact_map[h] for h in contacts_in_chat[id]]
-        chat_contacts = [contacts_map.get(contact, contact)
-                         for contact in chat_contacts]
-        # Because unique contact IDs are created for both SMS and iMessage on
-        # the same phone number, these need to be de-duped.
-        chat_contacts = list(set(chat_contacts))
-        filebase = '%s_%s' % (id, '_'.join(['-'.join(contact.split(' '))
-                                            for contact in chat_contacts]))
-        filename = filebase + '.html'
-        filepath = os.path.join(destination_dir, filename)
-        attachment_dir = os.path.join(destination_dir, filebase)
-        os.mkdir(attachment_dir)
-        with open(filepath, mode='w') as fh:
-            fh.write(HTML_START % ', '.join(chat_contacts))
+    # Contacts from every backup, so each device's archive can name people
+    # only another device knows.
+    with timer.stage('load contacts'):
+        contacts = ContactResolver.load_all(
+            contacts_db_files, os.path.join(output_dir, CONTACTS_CACHE_FILE_NAME), log)
 
-            for message in conversation:
+    # SQLite data.
+    message_filter = None
+    if opts.chats or opts.contacts or opts.since is not None or opts.until is not None:
+        message_filter = MessageFilter(opts.chats, opts.contacts, opts.since, opts.until)
+    shared_pool_dir = os.path.join(output_dir, ATTACHMENT_POOL_DIR_NAME) if batch else None
+    # Options changing the output, which a journaled export must be resumed
+    # with.
+    journal_options = {'incremental': opts.incremental, 'paging': opts.paging,
+                       'chats': opts.chats, 'contacts': opts.contacts,
+                       'since': opts.since, 'until': opts.until,
+                       'thumbnail_size': opts.thumbnail_size,
+                       'search_index': opts.search_index,
+                       'timezone': opts.timezone}
+    contexts = []
+    dbs = []
+    manifests = []
+    last_exported = []
+    ndjson_last_exported = []
+    search_index_files = []
+    for n, destination_dir in enumerate(destination_dirs):
+        db = MessageDatabase(sms_db_files[n], indexes[n], log, message_filter)
+        with timer.stage('load chats'):
+            chat_contacts = db.get_chat_contacts()
+        manifest = {}
+        if opts.incremental:
+            manifest = load_manifest(destination_dir, log)
+        if opts.incremental and opts.ndjson_file:
+            ndjson_last_exported.append(load_ndjson_marks(destination_dir))
+        else:
+            ndjson_last_exported.append({})
+        resumed = {}
+        if opts.journal:
+            resumed = load_journal(destination_dir, journal_options, log)
+            # Chats journaled as finished have nothing left to export, and
+            # partly exported ones carry on from their last finished page.
+            for id, entry in resumed.iteritems():
+                previous = manifest.get(id)
+                if previous is None or entry['last_message_id'] >= previous['last_message_id']:
+                    manifest[id] = entry
+        content_digests = None
+        if batch:
+            content_digests = load_content_digests(destination_dir)
+        search_index_file = None
+        if opts.search_index:
+            search_index_file = os.path.join(destination_dir, SEARCH_DB_FILE_NAME)
+            try:
+                search_index = SearchIndex(search_index_file, log)
+            except sqlite3.OperationalError as e:
+                log.error('Unable to create the search index (SQLite needs FTS5): %s', e)
+                sys.exit(1)
+            # Chats are exported from scratch unless incremental or resumed,
+            # so their messages are too.
+            if not opts.incremental and not resumed:
+                search_index.clear()
+            search_index.close()
+        context = ArchiveContext(indexes[n], destination_dir, sms_db_files[n],
+                                 chat_contacts, contacts, log, manifest,
+                                 opts.copy_threads, opts.paging, stats is not None,
+                                 search_index_file, message_filter, opts.thumbnail_size,
+                                 shared_pool_dir=shared_pool_dir, journal=opts.journal,
+                                 content_digests=content_digests)
+        contexts.append(context)
+        dbs.append(db)
+        manifests.append(manifest)
+        last_exported.append(dict((id, entry['last_message_id'])
+                                  for id, entry in manifest.iteritems()))
+        search_index_files.append(search_index_file)
+    # Copies into the attachment pool, and thumbnails, are locked by their
+    # temporary files, so any left by an interrupted export would hold them
+    # up for good.
+    if batch:
+        remove_stale_copies(shared_pool_dir)
+    else:
+        remove_stale_copies(os.path.join(output_dir, ATTACHMENT_POOL_DIR_NAME))
+    if opts.thumbnail_size:
+        for destination_dir in destination_dirs:
+            remove_stale_copies(os.path.join(destination_dir, THUMBNAIL_DIR_NAME,
+                                             str(opts.thumbnail_size)))
+    if opts.ndjson_file:
+        # Fail now rather than after the HTML export.
+        try:
+            open(opts.ndjson_file + '.tmp', 'wb').close()
+            os.remove(opts.ndjson_file + '.tmp')
+        except (IOError, OSError) as e:
+            log.error('Unable to write the NDJSON file: %s', e)
+            sys.exit(1)
+    if opts.container_file:
+        try:
+            contexts[0].container = open_container(opts.container_file)
+        except (IOError, ValueError) as e:
+            log.error('Unable to create the container: %s', e)
+            sys.exit(1)
+
+    chat_counts = None
+    if opts.jobs > 1 or opts.progress:
+        chat_counts = sorted(((n, id, count)
+                              for n, db in enumerate(dbs)
+                              for id, count in db.get_chat_message_counts(last_exported[n])),
+                             key=lambda chat: chat[2], reverse=True)
+    progress = None
+    if opts.progress:
+        chat_totals = dict(((n, id), count) for n, id, count in chat_counts)
+        progress = ProgressReporter(sum(chat_totals.itervalues()), opts.progress, log)
+    if not opts.html:
+        for db in dbs:
+            db.close()
+        results = []
+    elif opts.jobs > 1:
+        # Each worker opens the DBs for itself.
+        for db in dbs:
+            db.close()
+        results = export_conversations_parallel(contexts, opts.jobs, chat_counts)
+    else:
+        # Conversations are streamed so only one chat is in memory at a time.
+        results = export_backups(contexts, dbs, last_exported)
+    try:
+        with timer.stage('export'):
+            for n, id, entry, chat_stats in results:
+                # Also kept for the index of a paginated archive.
+                if opts.incremental or opts.paging:
+                    manifests[n][id] = entry
+                if progress:
+                    progress.update(chat_totals.get((n, id), 0))
+                if chat_stats is not None:
+                    stats.add_chat('%s/%s' % (backup_names[n], id) if batch else id,
+                                   chat_stats)
+            if opts.paging:
+                for n, context in enumerate(contexts):
+                    write_archive_index(manifests[n], context)
+        if opts.ndjson_file:
+            with timer.stage('write ndjson'):
+                ndjson_dbs = [MessageDatabase(sms_db_file, index, log, message_filter)
+                              for sms_db_file, index in zip(sms_db_files, indexes)]
+                ndjson_exported = [dict(marks) for marks in ndjson_last_exported]
                 try:
-                    message_parts = []
-
-                    # Name and service:
-                    if message['is_from_me']:
-                        my_string = '<dt class="sender_me">Me [%s]</dt>' % (message['service'],)
-                    else:
-                        contact = handle_contact_map[message['handle_id']]
-                        contact_name = contacts_map.get(contact, contact)
-                        my_string = '<dt class="sender_them">%s (%s) [%s]</dt>' % (contact_name, contact, message['service'])
-                    message_parts.append(my_string)
-
-                    # Sent time and message text:
-                    message_time = time.localtime(MAGIC_DATE_NUMBER + message['date'])
-                    message_time_str = time.strftime('%Y-%m-%d %H:%M:%S %Z', message_time)
-                    if message['text'] is None:
-                        my_string = '<dd class="text">[%s] [no text]</dd>' % (message_time_str,)
-                    else:
-                        message_text = '<br>'.join(message['text'].split('\n'))
-                        my_string = '<dd class="text">[%s] %s</dd>' % (message_time_str, message_text)
-                    message_parts.append(my_string)
-
-                    # Attachments:
-                    if message['message_id'] in attachments:
-                        for attachment_filename, true_filename in attachments[message['message_id']]:
-                            unique_filename = '%s-%s' % (attachment_filename, true_filename)
-                            file_from = os.path.join(backup_dir, attachment_filename)
-                            if not os.access(file_from, os.F_OK):
-                                file_from = os.path.join(backup_dir, attachment_filename[0:2], attachment_filename)
-                                if not os.access(file_from, os.F_OK):
-                                    my_string = '<dd class="attachment">Missing attachment (%s).</dd>' % (unique_filename,)
-                                    message_parts.append(my_string)
-                                    continue
-                            file_to = os.path.join(attachment_dir, unique_filename)
-                            shutil.copyfile(file_from, file_to)
-                            file_link = os.path.join(filebase, unique_filename)
-                            if unique_filename.split('.')[-1].lower() in ['jpeg', 'jpg', 'png', 'gif', 'svg']:
-                                my_string = '<dd class="attachment"><img src="%s" width=50%% /></dd>' % (file_link,)
-                                message_parts.append(my_string)
-                            my_string = '<dd class="attachment"><a href="%s">(%s)</a></dd>' % (file_link, unique_filename)
-                            message_parts.append(my_string)
-
-                    # Read time if applicable:
-                    if message['service'] == 'iMessage' and message['is_read'] == 1 and message['date_read'] != 0:
-                        read_time = time.localtime(MAGIC_DATE_NUMBER + message['date_read'])
-                        read_time_str = time.strftime('%Y-%m-%d %H:%M:%S %Z', read_time)
-                        my_string = '<dd class="readtime">Read at: %s</dd>' % (read_time_str,)
-                        message_parts.append(my_string)
-
-                    message_template = '<div class="message">\n%s\n</div>\n'
-                    all_message_parts = message_template % ('\n'.join(message_parts),)
-                    fh.write(all_message_parts.encode('utf8'))
-
-                except Exception as e:
-                    log.debug('An error occurred on message: %s', message)
-                    log.exception('Unexpected error: %s', e)
-
-            fh.write(HTML_END)
+                    write_ndjson(opts.ndjson_file,
+                                 (record
+                                  for n, context in enumerate(contexts)
+                                  for record in iter_message_records(
+                                      ndjson_dbs[n], context, ndjson_last_exported[n],
+                                      opts.html, backup_names[n] if batch else None,
+                                      ndjson_exported[n])),
+                                 log)
+                finally:
+                    for ndjson_db in ndjson_dbs:
+                        ndjson_db.close()
+                # Only once the file is in place.
+                if opts.incremental:
+                    for destination_dir, marks in zip(destination_dirs, ndjson_exported):
+                        save_ndjson_marks(destination_dir, marks)
+        if opts.journal:
+            # Finished, so there is nothing to resume.
+            for destination_dir in destination_dirs:
+                remove_journal(destination_dir)
+    finally:
+        with timer.stage('close'):
+            for context in contexts:
+                context.close()
+            container = contexts[0].container
+            if container:
+                if search_index_files[0]:
+                    container.add_file(search_index_files[0], SEARCH_DB_FILE_NAME)
+                container.close()
+        # Save progress even if the export failed part way, so the chats that
+        # were appended to are not appended to again.
+        if opts.incremental:
+            for destination_dir, manifest in zip(destination_dirs, manifests):
+                save_manifest(destination_dir, manifest, log)
+        if stats:
+            # Times from the main process, including the copies in serial mode.
+            for context in contexts:
+                stats.timer.merge(context.timer.take())
+                if context.copier:
+                    stats.copy_stats.update(context.copier.take_stats())
+            stats.save(opts.stats_file)
 
 
 if __name__ == "__main__":
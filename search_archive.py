@@ -0,0 +1,68 @@
+"""This Python script searches the messages of an archive written by
+ios_backup_message_archiver.py with --search-index.  The query is an SQLite
+FTS5 query, so words can be combined with AND, OR and NOT, quoted as phrases,
+matched by prefix (din*) or limited to a column (sender: alice, attachments:
+pdf).  Each hit is printed with its date, chat, sender and a snippet of the
+text, followed by the path of the chat page holding the message.
+
+:Date: 2026/10/16
+"""
+
+import json
+import optparse
+import sqlite3
+import sys
+import time
+
+import ios_backup_message_archiver as archiver
+
+
+def parse_cmd_line():
+    """Parse the options and arguments from the command line.
+
+    :Returns:
+        opts, args
+    """
+    usage = "usage: %prog [options] <path to archive directory> <query>"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option('-n', '--limit', dest='limit', type='int',
+                      help='Maximum number of hits to show, best first. [default: %default]',
+                      default=50)
+    parser.add_option('-j', '--json', dest='json',
+                      help='Print the hits as JSON.',
+                      action="store_true", default=False)
+    opts, args = parser.parse_args()
+    if len(args) < 2:
+        parser.error('An archive directory and a query are required.')
+    return opts, args
+
+def format_hit(hit):
+    """Format a search hit as text (unicode)."""
+    date = time.strftime('%Y-%m-%d %H:%M:%S',
+                         time.localtime(archiver.MAGIC_DATE_NUMBER + hit['date']))
+    return u'%s  %s  %s [%s]: %s\n    %s\n' % (
+        date, hit['chat_title'], hit['sender'], hit['service'],
+        ' '.join((hit['snippet'] or '').split()), hit['path'])
+
+
+def main():
+    opts, args = parse_cmd_line()
+    archive_dir = args[0]
+    query = ' '.join(args[1:]).decode(sys.getfilesystemencoding() or 'utf8')
+    started = time.time()
+    try:
+        hits = archiver.search_archive(archive_dir, query, opts.limit)
+    except sqlite3.OperationalError as e:
+        sys.stderr.write('Unable to search %s: %s\n' % (archive_dir, e))
+        sys.exit(1)
+    if opts.json:
+        json.dump(hits, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+        return
+    for hit in hits:
+        sys.stdout.write(format_hit(hit).encode('utf8'))
+    sys.stdout.write('%d hits in %.3f seconds.\n' % (len(hits), time.time() - started))
+
+
+if __name__ == "__main__":
+    main()